@@ -1,28 +1,28 @@
 import json
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from time import sleep
+from multiprocessing import get_context
+from time import sleep, time
 
 import numpy as np
 import pandas as pd
-import py_vollib.black_scholes_merton.implied_volatility as bcm_iv
 import pytz
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from colorama import Style, Fore
 from dateutil.relativedelta import relativedelta
 
-from common import logger, today, holidays
-from contracts import get_req_contracts
+from common import logger, today
+from contracts import ContractUniverse, get_universe
+from data_handler import Histogram
 from db_ops import DBHandler
-from greeks import get_greeks_intraday
+from greeks import get_greeks_vectorized, implied_volatility, QuantLibPricer
+from quote_table import QuoteTable
+from trading_calendar import trading_calendar, session_hours
 
-
-def network_days(start: str, end: str, holidays_arr: list):
-    b_days = pd.bdate_range(start=start, end=end, freq='C', weekmask='1111100', holidays=holidays_arr)
-    b_days = b_days.tolist()
-    b_days = [day + relativedelta(hour=15, minute=30, second=0, microsecond=0) for day in b_days]
-    return len(b_days)
+run_secs_edges = [0.5, 1, 2, 5, 10, 15, 30, 60]
 
 
 def diff_dt_num(dt1, dt2):
@@ -31,52 +31,209 @@ def diff_dt_num(dt1, dt2):
     return time_diff_num                    # return numeric diff
 
 
-def calc_dte(date_range):
-
-    dte = [0 for _ in date_range]
-    dates = []
-    for i in range(len(date_range)):
-        if i == 0:
-            dte[i] = 0.0
-        elif i == 1:
-            dte[i] = max(diff_dt_num(dt1=date_range[i], dt2=date_range[i-1]) / 6.25 * 24, 0)
+def get_dte(row: pd.Series, dt):
+    return trading_calendar.dte(dt, row['expiry'])
+
+
+def get_greeks_dte(spot, strike, premium, dte, opt, r=0, q=0, initial=None):
+    # Whole chain at once; below-intrinsic / above-maximum prices come back as NaN
+    t = np.asarray(dte, dtype=float) / 365
+    return implied_volatility(premium, spot, strike, t, r, q, opt, initial=initial) * 100
+
+
+def _same(prev, curr, rtol, atol=0):
+    return np.isclose(prev, curr, rtol=rtol, atol=atol) | (np.isnan(prev) & np.isnan(curr))
+
+
+class IVCache:
+    """
+    Last solved IV per tradingsymbol, kept across scheduler runs.
+    A contract whose ltp and spot are unchanged (within rtol) and whose dte moved less than dte_atol and dte_rtol since its
+    last solve reuses that IV without a solve; any other known contract is solved with its previous IV as the initial
+    guess. dte_atol is in dte days, 5 minutes of the session by default. IV moves by about half the relative dte move,
+    so dte_rtol keeps a reused IV within ~0.05% of a fresh solve and re-solves every run close to expiry.
+    hits: rows found in the cache, skips: rows served without a solve, solves: rows sent to the solver.
+    """
+
+    def __init__(self, rtol=1e-9, dte_atol=5 / (session_hours * 60), dte_rtol=1e-3):
+        self.rtol = rtol
+        self.dte_atol = dte_atol
+        self.dte_rtol = dte_rtol
+        self.state = pd.DataFrame(columns=['ltp', 'spot', 'dte', 'iv'], dtype=float)
+        self.hits = 0
+        self.skips = 0
+        self.solves = 0
+
+    def get_iv(self, symbols, spot, strike, premium, dte, opt, r=0, q=0):
+        spot, strike, premium, dte = [np.asarray(_a, dtype=float) for _a in (spot, strike, premium, dte)]
+        opt = np.asarray(opt)
+        known = np.isin(symbols, self.state.index)
+        prev = self.state.reindex(symbols)
+        prev_iv = prev['iv'].values
+        skip = known & _same(prev['ltp'].values, premium, self.rtol) & _same(prev['spot'].values, spot, self.rtol) \
+            & _same(prev['dte'].values, dte, 0, self.dte_atol) & _same(prev['dte'].values, dte, self.dte_rtol)
+        solve = ~skip
+        initial = np.where(known & np.isfinite(prev_iv), prev_iv / 100, np.nan)
+
+        iv = prev_iv.copy()
+        iv[solve] = get_greeks_dte(spot[solve], strike[solve], premium[solve], dte[solve], opt[solve], r, q,
+                                   initial=initial[solve])
+
+        self.hits += int(known.sum())
+        self.skips += int(skip.sum())
+        self.solves += int(solve.sum())
+        # Skipped rows keep the inputs of their last solve, so dte cannot creep past dte_atol a run at a time
+        latest = pd.DataFrame({'ltp': premium[solve], 'spot': spot[solve], 'dte': dte[solve], 'iv': iv[solve]},
+                              index=pd.Index(symbols[solve]))
+        self.state = pd.concat([self.state[~self.state.index.isin(latest.index)], latest])
+        return iv
+
+    def evict(self, symbols):
+        """Drop contracts that are no longer part of the universe"""
+        self.state = self.state[self.state.index.isin(symbols)]
+
+    def stats(self):
+        return {'size': len(self.state), 'hits': self.hits, 'skips': self.skips, 'solves': self.solves}
+
+
+class GreeksEngine:
+    """
+    Greeks and IV for contracts whose ltp, spot and dte are filled in. Holds the per-process solver state, so one
+    instance lives in SnapAnalysis and one in every parallel worker.
+    """
+
+    def __init__(self, rate, use_vectorized=False):
+        self.rate = rate
+        self.use_vectorized = use_vectorized
+        self.iv_cache = IVCache()
+        self.ql_pricer = QuantLibPricer()
+
+    def evict(self, symbols):
+        self.iv_cache.evict(symbols)
+        self.ql_pricer.evict(symbols)
+
+    def compute(self, opt_df: pd.DataFrame, dt):
+        if self.use_vectorized:
+            greeks = self.vector_greeks(opt_df, dt)
         else:
-            dte[i] = max(network_days(start=date_range[1], end=date_range[i], holidays_arr=holidays) - 1 + dte[1],
-                         network_days(start=date_range[1], end=date_range[i], holidays_arr=holidays) - 1)
-        dates.append(date_range[i])
+            greeks = self.ql_greeks(opt_df, dt)
+        # Recalculate IV
+        greeks['iv'] = self.iv_cache.get_iv(opt_df['symbol'].values, opt_df['spot'].values, opt_df['strike'].values,
+                                            opt_df['ltp'].values, opt_df['dte'].values, opt_df['opt'].values)
+        logger.info(f'IV cache: {self.iv_cache.stats()}')
+        return greeks
+
+    def ql_greeks(self, opt_df: pd.DataFrame, dt):
+        greeks = self.ql_pricer.get_greeks(opt_df['symbol'].values, opt_df['spot'].astype(float).values,
+                                           opt_df['strike'].values, opt_df['expiry'], opt_df['opt'].values,
+                                           opt_df['ltp'].astype(float).values, dt, risk_free_rate=self.rate / 100)
+        return pd.DataFrame(greeks, index=opt_df.index)
+
+    def vector_greeks(self, opt_df: pd.DataFrame, dt):
+        # Same Actual/365 year fraction QuantLib derives from the wall-clock evaluation and expiry dates
+        calc_dt = pd.Timestamp(dt.replace(tzinfo=None))
+        t = (opt_df['expiry'] - calc_dt).dt.total_seconds().values / (365 * 24 * 60 * 60)
+        greeks = get_greeks_vectorized(opt_df['spot'].values, opt_df['strike'].values, t, opt_df['opt'].values,
+                                       opt_df['ltp'].values, risk_free_rate=self.rate / 100)
+        return pd.DataFrame(greeks, index=opt_df.index)
+
+
+class StrikeGrid:
+    """
+    Sorted unique strikes of every (underlying, expiry), laid end to end so strike selection for all groups is one
+    vectorized pass. A group's step is the smallest gap between its strikes, the last gap excluded, as in the former
+    row-wise mround. Groups are numbered in (underlying, expiry) order, the order of a groupby on them.
+    """
+
+    def __init__(self, opt_df: pd.DataFrame):
+        grid = opt_df[['underlying', 'expiry', 'strike']].drop_duplicates().sort_values(['underlying', 'expiry', 'strike'])
+        keys = pd.MultiIndex.from_frame(grid[['underlying', 'expiry']])
+        self.index = keys.unique()  # group id -> (underlying, expiry)
+        self.groups = self.index.to_frame(index=False)
+        gid = self.index.get_indexer(keys)
+        self.strikes = grid['strike'].to_numpy(dtype=float)
+        self.gid = gid
+        # Composite (group, strike) keys, increasing, so one searchsorted serves every group
+        self.stride = 2 * (np.abs(self.strikes).max(initial=0) + 1)
+        self._keys = gid * self.stride + self.strikes
+        gaps = np.diff(self.strikes)
+        same = gid[1:] == gid[:-1]
+        last_gap = np.append(gid[2:] != gid[1:-1], True) if len(gaps) else np.array([], dtype=bool)
+        usable = same & ~last_gap
+        self.step = np.full(len(self.index), np.nan)
+        np.fmin.at(self.step, gid[1:][usable], gaps[usable])
+
+    def group_ids(self, underlying, expiry) -> np.ndarray:
+        """Group id of every (underlying, expiry) pair, -1 for pairs outside the grid"""
+        return self.index.get_indexer(pd.MultiIndex.from_arrays([underlying, expiry]))
+
+    def floor(self, gid: np.ndarray, price) -> np.ndarray:
+        """Highest strike of the group at or below price, NaN when there is none"""
+        price = np.asarray(price, dtype=float)
+        query = gid * self.stride + np.clip(price, -self.stride / 2, self.stride / 2)
+        pos = np.searchsorted(self._keys, query, side='right') - 1
+        found = (gid >= 0) & (pos >= 0) & ~np.isnan(price)
+        found &= self.gid[np.maximum(pos, 0)] == gid
+        return np.where(found, self.strikes[np.maximum(pos, 0)], np.nan)
+
+    def mround(self, gid: np.ndarray, price) -> np.ndarray:
+        """Price rounded to the nearest multiple of the group's step, ties away from zero, like excel mround"""
+        price = np.asarray(price, dtype=float)
+        base = np.where(gid >= 0, self.step[gid], np.nan)
+        m1 = base * np.trunc(price / base)
+        m2 = m1 + base
+        return np.where(np.abs(price - m1) < np.abs(price - m2), m1, m2)
 
-    dte = pd.DataFrame({'date': dates, 'dte': dte})
-    return dte
 
+class StraddlePairs:
+    """
+    Call/put pairing of opt_df by (underlying, expiry, strike), sorted on those keys: for every pair the opt_df
+    positions of its call and put (-1 where the leg is not listed), and the start of every (underlying, expiry) run
+    for segment reductions.
+    """
 
-def get_dte(row: pd.Series, dt):
-    current_dt = [dt, dt.date() + relativedelta(hour=15, minute=30, second=0, microsecond=0)]  # static
-    after_current_dt = pd.date_range(start=dt.date(), end=row['expiry'].date()).tolist()
-    after_current_dt = [(date + relativedelta(hour=15, minute=30, second=0, microsecond=0)).to_pydatetime() for date in
-                        after_current_dt]
-    date_range = pd.Series(current_dt + after_current_dt)
-    dte_all = calc_dte(date_range=date_range)
-    dte = dte_all['dte'].iloc[-1]
-    return dte
-
-
-def get_greeks_dte(spot, strike, premium, dte, opt, r=0, q=0):
-    t = dte / 365
-    flag = str(opt)[:1].lower()
-    try:
-        iv = bcm_iv.implied_volatility(premium, spot, strike, t, r, q, flag) * 100
-    except (bcm_iv.PriceIsBelowIntrinsic, bcm_iv.PriceIsAboveMaximum, Exception):
-        iv = None
-    return iv
+    def __init__(self, opt_df: pd.DataFrame):
+        keys = ['underlying', 'expiry', 'strike']
+        legs = opt_df[keys].assign(pos=np.arange(len(opt_df)), opt=opt_df['opt'].values)
+        calls = legs[legs['opt'] == 'CE'].drop(columns=['opt'])
+        puts = legs[legs['opt'] == 'PE'].drop(columns=['opt'])
+        pairs = calls.merge(puts, on=keys, how='outer', suffixes=('_c', '_p')).sort_values(keys)
+        self.keys = pairs[keys].reset_index(drop=True)
+        self.call = pairs['pos_c'].fillna(-1).to_numpy(dtype=np.int64)
+        self.put = pairs['pos_p'].fillna(-1).to_numpy(dtype=np.int64)
+        group = pd.MultiIndex.from_frame(self.keys[['underlying', 'expiry']])
+        self.gid = pd.factorize(group)[0]
+
+    def __len__(self):
+        return len(self.call)
+
+
+_shard_meta: pd.DataFrame = None
+_shard_engine: GreeksEngine = None
+
+
+def _init_greeks_worker(meta: pd.DataFrame, rate, use_vectorized):
+    global _shard_meta, _shard_engine
+    _shard_meta = meta
+    _shard_engine = GreeksEngine(rate, use_vectorized)
+
+
+def _greeks_shard(key, rows, ltp, spot, dte, dt):
+    st = time()
+    shard = _shard_meta.loc[rows].copy()
+    shard['ltp'], shard['spot'], shard['dte'] = ltp, spot, dte
+    greeks = _shard_engine.compute(shard, dt)
+    return key, greeks, time() - st
 
 
 class SnapAnalysis:
 
-    def __init__(self, ins_df, tokens, token_xref, shared_xref, **kwargs):
+    def __init__(self, universe: ContractUniverse, shared_xref, **kwargs):
         super().__init__()
-        self.ins_df = ins_df
-        self.tokens = tokens
-        self.token_xref = token_xref
+        self.universe = universe
+        self.ins_df = universe.ins_df
+        self.tokens = universe.tokens
+        self.token_xref = universe.token_xref
         self.shared_xref = shared_xref
         self.rate = kwargs.get('rate', 10)
         self.insert = kwargs.get('insert', True)
@@ -84,9 +241,38 @@ class SnapAnalysis:
         self.use_synthetic = kwargs.get('use_synthetic', False)
         self.use_forward_fut = kwargs.get('use_forward_fut', False)
         self.use_future = kwargs.get('use_future', False)
+        self.use_vectorized = kwargs.get('use_vectorized', False)  # NumPy greeks engine, QuantLib stays the reference
+        # Recompute greeks only for contracts whose ltp/spot/oi moved, and every contract once the dte_bucket minutes
+        # window rolls over. Recomputed contracts are priced at the snap time
+        self.incremental = kwargs.get('incremental', False)
+        self.dte_bucket = kwargs.get('dte_bucket', 5)
+        self._last_bucket = None
+        # Cadences in secs: every calc run replaces opt_straddle_live, opt_greeks/opt_straddle and snap are persisted
+        # on the first calc run of each of their own intervals. A run taking longer than time_budget secs is an overrun
+        self.calc_secs = kwargs.get('calc_secs', 60)
+        self.persist_secs = kwargs.get('persist_secs', 60)
+        self.snap_secs = kwargs.get('snap_secs', 60)
+        self.time_budget = kwargs.get('time_budget', 0.8 * self.calc_secs)
+        self.run_hist = Histogram(run_secs_edges)
+        self.overruns = 0
+        self.skipped = 0  # runs not started, the previous one was still running or the run was missed
+        self._last_persist = None
+        self._last_snap = None
 
         self.opt_df = None
         self.fut_map = None
+        # Quote slot of every opt_df row, see prepare_meta
+        self.entity_slot = {}
+        self.opt_pos = self.spot_pos = self.fut_pos = None
+        self.strike_grid = None
+        self.straddle_pairs = None
+        self.engine = GreeksEngine(self.rate, self.use_vectorized)
+        # Greeks worker processes, 0 computes in-process. Contracts are sharded by shard_by columns
+        self.workers = kwargs.get('workers', 0)
+        self.shard_by = kwargs.get('shard_by', ['underlying'])
+        self.pool = None
+        self.last_inputs = pd.DataFrame(columns=self.greeks_inputs, dtype=float)
+        self.last_greeks = pd.DataFrame()
         self.prepare_meta()
 
         self.scheduler = None
@@ -94,17 +280,45 @@ class SnapAnalysis:
             self.scheduler: BackgroundScheduler = self.init_scheduler()
             self.scheduler.start()  # Scheduler starts
 
+    def refresh_universe(self):
+        """Reload a stale contract universe and rebuild the meta, evicting contracts gone from it from the caches"""
+        if self.universe.is_valid():
+            return False
+        self.universe = get_universe()
+        self.ins_df, self.tokens, self.token_xref = self.universe
+        self.prepare_meta()
+        return True
+
     def prepare_meta(self):
-        req_df, token, token_xref = get_req_contracts()
-        meta_df: pd.DataFrame = req_df[req_df['segment'] == 'NFO-OPT'].copy()
-        renames = {'tradingsymbol': 'symbol', 'name': 'underlying', 'instrument_type': 'opt'}
-        opt_df = meta_df[['tradingsymbol', 'name', 'expiry', 'strike', 'instrument_type']].copy().rename(columns=renames)
-        opt_df['expiry'] = opt_df['expiry'].apply(lambda x: x + relativedelta(hour=15, minute=30))
-        self.opt_df = opt_df
+        if not self.universe.is_valid():
+            logger.warning(f'Contract universe of {self.universe.day:%Y-%m-%d} is stale')
+        opt_df = self.universe.opt_df
+        self.opt_df = opt_df.copy()
+        self.engine.evict(opt_df['symbol'])
+        self.last_inputs = self.last_inputs[self.last_inputs.index.isin(opt_df['symbol'])]
+        self.last_greeks = self.last_greeks[self.last_greeks.index.isin(opt_df['symbol'])]
         # Check if FUT available
-        fut_df: pd.DataFrame = req_df[req_df['segment'] == 'NFO-FUT'].copy()
-        req_fut = fut_df.sort_values('expiry')[['tradingsymbol', 'name']].drop_duplicates(keep='first').rename(columns=renames, errors='ignore')
-        self.fut_map = req_fut.set_index('underlying').to_dict()['symbol']
+        self.fut_map = self.universe.fut_map
+        # Slots in the quote table's order of token_xref, so a snapshot is gathered per row with one fancy index
+        if isinstance(self.shared_xref, QuoteTable):
+            self.entity_slot = self.shared_xref.entity_slot
+        else:
+            self.entity_slot = {_entity: _slot for _slot, _entity in enumerate(self.token_xref.values())}
+        self.opt_pos = self.slot_positions(self.opt_df['symbol'])
+        self.spot_pos = self.slot_positions(self.opt_df['underlying'])
+        self.fut_pos = self.slot_positions(self.opt_df['underlying'].map(lambda x: self.fut_map.get(x, x)))
+        self.strike_grid = StrikeGrid(self.opt_df)
+        self.straddle_pairs = StraddlePairs(self.opt_df)
+        if self.workers:
+            self.init_pool()
+
+    def init_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn'),
+                                        initializer=_init_greeks_worker,
+                                        initargs=(self.opt_df, self.rate, self.use_vectorized))
+        logger.info(f'Greeks pool started with {self.workers} workers')
 
     def init_scheduler(self):
         if self.scheduler is not None:
@@ -117,10 +331,11 @@ class SnapAnalysis:
         job_defaults = {
             'coalesce': True,
             'max_instances': 1,
-            'misfire_grace_time': 10
+            'misfire_grace_time': min(10, self.calc_secs)
         }
         self.scheduler = BackgroundScheduler(executors=executors, job_defaults=job_defaults, timezone='Asia/Kolkata',
                                              logger=logger)
+        self.scheduler.add_listener(self.on_job_skipped, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
         self.add_jobs_to_scheduler()
         return self.scheduler
 
@@ -130,54 +345,81 @@ class SnapAnalysis:
 
         # Add jobs
         trigger_pre = IntervalTrigger(minutes=1, start_date=mkt_open - relativedelta(minutes=5), end_date=mkt_open)
-        trigger_snap = IntervalTrigger(minutes=1, start_date=mkt_open, end_date=mkt_close)
+        trigger_snap = IntervalTrigger(seconds=self.calc_secs, start_date=mkt_open, end_date=mkt_close)
         self.scheduler.add_job(self.run_analysis, trigger_pre, kwargs=dict(calc=False), id='snap_1',
                                name=f'SnapDataAnalysisPre')
         self.scheduler.add_job(self.run_analysis, trigger_snap, kwargs=dict(calc=True), id='snap_2',
                                name=f'SnapDataAnalysis')
 
+    def on_job_skipped(self, event):
+        self.skipped += 1
+        # JobSubmissionEvent (max instances) carries every run time, JobExecutionEvent (missed) a single one
+        run_times = getattr(event, 'scheduled_run_times', None) or [event.scheduled_run_time]
+        logger.warning(f'Analysis run of {", ".join(map(str, run_times))} skipped by {event.job_id}, '
+                       f'{self.skipped} skipped so far: calc cadence of {self.calc_secs} secs not sustained')
+
+    @staticmethod
+    def _due(dt, secs, last):
+        """Interval of `secs` that dt falls in, None if `last` already covered it"""
+        interval = int(dt.timestamp()) // secs
+        return None if interval == last else interval
+
     def run_analysis(self, calc=True):
+        st = time()
+        self.refresh_universe()
         dt = datetime.now(tz=pytz.timezone('Asia/Kolkata')).replace(microsecond=0)
-        xref = self.shared_xref.copy()
-        logger.info(f'length of xref is {len(xref)}')
-        data = {'timestamp': dt.isoformat(), 'snap': xref}
-        db_data = json.loads(json.dumps(data, default=str))
-        if self.insert:
-            DBHandler.insert_snap_data([db_data])
+        snap = self.shared_xref.snapshot()
+        watermark = QuoteTable.watermark(snap)
+        logger.info(f'length of snap is {len(snap["last_price"])}, exchange time watermark {watermark}')
+        snap_due = self._due(dt, self.snap_secs, self._last_snap)
+        if self.insert and snap_due is not None:
+            data = {'timestamp': dt.isoformat(), 'snap': self.shared_xref.to_xref(snap)}
+            DBHandler.insert_snap_data([json.loads(json.dumps(data, default=str))])
+            self._last_snap = snap_due
 
         if calc:
             logger.info(f'calc values for {dt}')
-            greeks_df = self.opt_calc(snap=xref, dt=dt)
-            self.straddle_calc(greeks_df)
-
-    @staticmethod
-    def floor_strike(row):
-        strikes = np.array(row['strike'])
-        st = strikes[strikes <= row['current']].max()
-        return st
-
-    @staticmethod
-    def mround_strike(row, price_col='current'):
-        """Similar to excel mround function"""
-        price = row[price_col]
-        strikes = pd.Series(row['strike'])
-        strikes = strikes.drop_duplicates().sort_values()
-        base = (strikes[1:] - strikes.shift(1)[:-1]).min()
-        m1 = base * int(price / base)
-        m2 = m1 + base
-        m = m1 if abs(price - m1) < abs(price - m2) else m2
-        return m
-
-    def opt_calc(self, snap, dt):
+            persist_due = self._due(dt, self.persist_secs, self._last_persist)
+            persist = self.insert and persist_due is not None
+            greeks_df = self.opt_calc(snap=snap, dt=dt, watermark=watermark, insert=persist)
+            straddle_df = self.straddle_calc(greeks_df, insert=persist)
+            if self.insert:
+                self.publish_live(straddle_df)
+            if persist:
+                self._last_persist = persist_due
+
+        elapsed = time() - st
+        self.run_hist.add(elapsed)
+        if calc and elapsed > self.time_budget:
+            self.overruns += 1
+            logger.warning(f'Analysis run of {dt} took {elapsed:.2f} secs, over its {self.time_budget:.2f} secs budget '
+                           f'({self.overruns} overruns so far). Run times: {self.run_hist.summary()}')
+
+    live_cols = ['timestamp', 'exchange_ts', 'underlying', 'expiry', 'strike', 'spot', 'call_price', 'put_price',
+                 'call_oi', 'put_oi', 'call_iv', 'put_iv', 'combined_premium', 'combined_iv', 'otm_iv']
+
+    def publish_live(self, straddle_df: pd.DataFrame):
+        """Replace opt_straddle_live with the minima of this run, served by the /straddle/live API"""
+        live = straddle_df[straddle_df['minima'] & straddle_df['combined_premium'].notna()]
+        live = live.drop_duplicates(['underlying', 'expiry'])[self.live_cols]
+        DBHandler.replace_straddle_live(live.replace({np.NAN: None}).to_dict('records'))
+
+    def opt_calc(self, snap, dt, watermark=None, insert=None):
+        """
+        :param snap: quote table snapshot (QuoteTable.snapshot) or entity -> {last_price, oi} dict of a stored snap
+        :param insert: write to opt_greeks, self.insert if None
+        """
+        snap = self.snap_columns(snap)
+        ltp = snap['last_price']
         opt_df: pd.DataFrame = self.opt_df.copy()
-        opt_df['ltp'] = opt_df['symbol'].apply(self.get_ltp, args=(snap,))
-        opt_df['oi'] = opt_df['symbol'].apply(self.get_oi, args=(snap,))
+        opt_df['ltp'] = self.gather(ltp, self.opt_pos)
+        opt_df['oi'] = self.gather(snap['oi'], self.opt_pos)
         if self.use_future:
-            opt_df['spot'] = opt_df['underlying'].apply(lambda x: self.get_ltp(self.fut_map.get(x, x), snap))
+            opt_df['spot'] = self.gather(ltp, self.fut_pos)
         elif self.use_synthetic:
-            underlyings = opt_df.groupby(['underlying', 'expiry'], as_index=False).agg({'strike': list})
-            underlyings['current'] = underlyings['underlying'].apply(self.get_ltp, args=(snap,))
-            underlyings['strike'] = underlyings.apply(self.floor_strike, axis=1)
+            underlyings = self.strike_grid.groups.copy()
+            underlyings['current'] = self.gather(ltp, self.slot_positions(underlyings['underlying']))
+            underlyings['strike'] = self.strike_grid.floor(underlyings.index.to_numpy(), underlyings['current'])
 
             req_strikes = opt_df.merge(underlyings, how='inner', on=['underlying', 'expiry', 'strike'])
             req_strikes = req_strikes.drop(columns=['oi', 'current'])
@@ -188,17 +430,14 @@ class SnapAnalysis:
             underlying_df['spot'] = underlying_df['ltp_call'].fillna(0) - underlying_df['ltp_put'].fillna(0) + underlying_df['strike']
             underlying_df = underlying_df[['underlying', 'expiry', 'spot']]
 
-            opt_df = opt_df.merge(underlying_df, how='inner', on=['underlying', 'expiry'])
+            opt_df = opt_df.join(underlying_df.set_index(['underlying', 'expiry']), on=['underlying', 'expiry'], how='inner')
         elif self.use_forward_fut:
-            underlyings = opt_df.groupby(['underlying', 'expiry'], as_index=False).agg({'strike': list})
-            underlyings['current'] = underlyings['underlying'].apply(lambda x: self.get_ltp(self.fut_map.get(x, x), snap))
+            underlyings = self.strike_grid.groups.copy()
+            futures = underlyings['underlying'].map(lambda x: self.fut_map.get(x, x))
+            underlyings['current'] = self.gather(ltp, self.slot_positions(futures))
             underlyings.dropna(subset=['current'], inplace=True)
-
-            logger.info(f"\nBefore apply: {underlyings.shape}")
-            # logger.info(f"\nBefore apply strike is: \n{underlyings['strike']}")
-            underlyings['strike'] = underlyings.apply(self.mround_strike, axis=1)
-            logger.info(f"After apply: {underlyings.shape}")
-            # logger.info(f"\nAfter apply strike is: \n{underlyings['strike']}")
+            underlyings['strike'] = self.strike_grid.mround(underlyings.index.to_numpy(), underlyings['current'])
+            logger.info(f"Forward strikes for {underlyings.shape[0]} underlying expiries")
 
             req_strikes = opt_df.merge(underlyings, how='inner', on=['underlying', 'expiry', 'strike'])
             req_strikes = req_strikes.drop(columns=['oi', 'current'])
@@ -209,81 +448,153 @@ class SnapAnalysis:
             underlying_df['spot'] = underlying_df['ltp_call'].fillna(0) - underlying_df['ltp_put'].fillna(0) + underlying_df['strike']
             underlying_df = underlying_df[['underlying', 'expiry', 'spot']]
 
-            opt_df = opt_df.merge(underlying_df, how='inner', on=['underlying', 'expiry'])
+            opt_df = opt_df.join(underlying_df.set_index(['underlying', 'expiry']), on=['underlying', 'expiry'], how='inner')
         else:
-            opt_df['spot'] = opt_df['underlying'].apply(self.get_ltp, args=(snap,))
+            opt_df['spot'] = self.gather(ltp, self.spot_pos)
 
-        greeks = opt_df.apply(
-            lambda x: pd.Series(get_greeks_intraday(x['spot'], x['strike'], x['expiry'], x['opt'], x['ltp'], dt,
-                                                    risk_free_rate=self.rate / 100)),
-            axis=1)
-        # Recalculate IV
-        exp_df = opt_df.groupby(['underlying', 'expiry']).count()['strike'].reset_index().drop(columns=['strike'])
-        exp_df['dte'] = exp_df.apply(get_dte, axis=1, dt=dt.replace(tzinfo=None))
-        opt_df = opt_df.merge(exp_df, on=['underlying', 'expiry'])
-        dte_iv = opt_df.apply(lambda x: get_greeks_dte(x['spot'], x['strike'], x['ltp'], x['dte'], x['opt']), axis=1)
-        greeks['iv'] = dte_iv
+        opt_df['dte'] = trading_calendar.dte(dt.replace(tzinfo=None), opt_df['expiry'])
+        greeks = self.greeks_calc(opt_df, dt)
 
         df = opt_df.join(greeks)
         df.insert(0, 'timestamp', dt)
-        if self.insert:
+        df.insert(1, 'exchange_ts', watermark)  # Exchange time of the latest tick in the snap
+        if self.insert if insert is None else insert:
             DBHandler.insert_opt_greeks(df.replace({np.NAN: None}).to_dict('records'))
         return df
 
-    def straddle_calc(self, df: pd.DataFrame):
-        call_df = df[(df['opt'] == 'CE')].copy()
-        put_df = df[(df['opt'] == 'PE')].copy()
-
-        # straddle values
-        oc_df = call_df.merge(put_df, on=['timestamp', 'underlying', 'expiry', 'strike'], how='outer', suffixes=('_c', '_p'))
-        oc_df.sort_values(['timestamp', 'underlying', 'expiry', 'strike'], inplace=True)
-        non_zero = (oc_df['ltp_c'] != 0) & (oc_df['ltp_p'] != 0)
-        oc_df.loc[non_zero, 'combined_premium'] = (oc_df['ltp_c'] + oc_df['ltp_p'])[non_zero]
-        oc_df.loc[non_zero, 'combined_iv'] = (oc_df[['iv_c', 'iv_p']].mean(axis=1))[non_zero]
-        # ATM calc
-        # call_otm = oc_df['strike'] >= oc_df['spot_c']
-        atm_df = oc_df.groupby(['underlying', 'expiry', 'spot_c'], as_index=False).agg({'strike': list})
-
-        logger.info(f"\nBefore apply: {atm_df.shape}")
-        logger.info(f"\nBefore apply implied atm is: \n{atm_df['implied_atm']}")
-        atm_df['implied_atm'] = atm_df.apply(self.mround_strike, axis=1, price_col='spot_c')
-        logger.info(f"\nAfter apply: {atm_df.shape}")
-        logger.info(f"\nAfter apply implied atm is: \n{atm_df['implied_atm']}")
-        
-        atm_df = atm_df[['underlying', 'expiry', 'implied_atm']].copy()
-        oc_df = oc_df.merge(atm_df, on=['underlying', 'expiry'])  # map atm
-        call_otm = oc_df['strike'] > oc_df['implied_atm']
+    greeks_inputs = ['ltp', 'spot', 'oi']
+
+    def greeks_calc(self, opt_df: pd.DataFrame, dt):
+        if not self.incremental:
+            return self.compute_greeks(opt_df, dt)
+
+        # dte moves every run: a new bucket recomputes every contract, within one only changed quotes are recomputed
+        bucket = int(dt.timestamp()) // (self.dte_bucket * 60)
+        if bucket != self._last_bucket:
+            self.last_inputs = self.last_inputs.iloc[0:0]
+            self._last_bucket = bucket
+        symbols = opt_df['symbol'].values
+        inputs = opt_df[self.greeks_inputs].astype(float)
+        prev = self.last_inputs.reindex(symbols)
+        unchanged = np.isin(symbols, self.last_inputs.index)
+        for _col in self.greeks_inputs:
+            unchanged &= _same(prev[_col].values, inputs[_col].values, rtol=0)
+        changed = ~unchanged
+        logger.info(f'Greeks recomputed for {changed.sum()} of {len(opt_df)} contracts')
+
+        cached = self.last_greeks.reindex(symbols[unchanged]).set_axis(opt_df.index[unchanged])
+        fresh = self.compute_greeks(opt_df[changed], dt)
+        greeks = pd.concat([cached, fresh]).loc[opt_df.index]
+
+        inputs.index = symbols
+        self.last_inputs = pd.concat([self.last_inputs[~self.last_inputs.index.isin(symbols)], inputs])
+        self.last_greeks = pd.concat([self.last_greeks[~self.last_greeks.index.isin(symbols)],
+                                      greeks.set_axis(symbols)])
+        return greeks
+
+    def compute_greeks(self, opt_df: pd.DataFrame, dt):
+        if self.pool is None:
+            return self.engine.compute(opt_df, dt)
+
+        # Only the per-run vectors travel, contract metadata is already resident in the workers
+        futures = []
+        for _key, _shard in opt_df.groupby(self.shard_by, sort=False):
+            futures.append(self.pool.submit(_greeks_shard, _key, _shard.index.values, _shard['ltp'].astype(float).values,
+                                            _shard['spot'].astype(float).values, _shard['dte'].values, dt))
+        results, timings = [], {}
+        for _future in futures:
+            _key, _greeks, _elapsed = _future.result()
+            results.append(_greeks)
+            timings[_key] = round(_elapsed, 3)
+        logger.info(f'Greeks shard timings (secs): {timings}')
+        if not results:
+            return self.engine.compute(opt_df, dt)
+        return pd.concat(results).loc[opt_df.index]
+
+    straddle_leg_cols = ['symbol', 'spot', 'ltp', 'oi', 'iv']
+
+    def straddle_calc(self, df: pd.DataFrame, insert=None):
+        """
+        Straddle rows of one snap from the prebuilt call/put pairs, no joins.
+        :param df: opt_calc output, indexed like opt_df
+        :param insert: write to opt_straddle, self.insert if None
+        """
+        watermark = df['exchange_ts'].iloc[0] if len(df) else None
+        pairs = self.straddle_pairs
+        # Row of df holding each leg, -1 where the leg is not in this snap
+        row_of = np.full(len(self.opt_df) + 1, -1, dtype=np.int64)
+        row_of[df.index.to_numpy()] = np.arange(len(df))
+        call_row, put_row = row_of[pairs.call], row_of[pairs.put]
+
+        legs = {}
+        for _side, _rows in (('c', call_row), ('p', put_row)):
+            has_leg = _rows >= 0
+            for _col in self.straddle_leg_cols:
+                _values = df[_col].to_numpy()
+                _leg = np.full(len(pairs), np.nan, dtype=_values.dtype if _values.dtype.kind == 'f' else object)
+                _leg[has_leg] = _values[_rows[has_leg]]
+                legs[f'{_col}_{_side}'] = _leg
+
+        # ATM from the call leg's spot; pairs of expiries without one are left out
+        spot_c = legs['spot_c']
+        group_spot = np.full(pairs.gid.max(initial=-1) + 1, np.nan)
+        group_spot[pairs.gid[~np.isnan(spot_c)]] = spot_c[~np.isnan(spot_c)]
+        keep = ((call_row >= 0) | (put_row >= 0)) & ~np.isnan(group_spot[pairs.gid])
+        keys = pairs.keys[keep].reset_index(drop=True)
+        legs = {_col: _leg[keep] for _col, _leg in legs.items()}
+        gid = pairs.gid[keep]
+        grid_gid = self.strike_grid.group_ids(keys['underlying'], keys['expiry'])
+        implied_atm = self.strike_grid.mround(grid_gid, group_spot[gid])
+        logger.info(f"Implied ATM for {len(np.unique(gid))} underlying expiries")
+
+        ltp_c, ltp_p, iv_c, iv_p = legs['ltp_c'], legs['ltp_p'], legs['iv_c'], legs['iv_p']
+        non_zero = (ltp_c != 0) & (ltp_p != 0)
+        combined_premium = np.where(non_zero, ltp_c + ltp_p, np.nan)
+        iv_count = (~np.isnan(iv_c)).astype(int) + ~np.isnan(iv_p)
+        iv_sum = np.nan_to_num(iv_c) + np.nan_to_num(iv_p)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            combined_iv = np.where(non_zero & (iv_count > 0), iv_sum / iv_count, np.nan)
         # OTM IV
-        oc_df['otm_iv'] = np.where(call_otm, oc_df['iv_c'].values, oc_df['iv_p'].values)
-        min_combined = oc_df.groupby(['timestamp', 'underlying', 'expiry'], as_index=False).agg({'combined_premium': 'min'})
-        min_combined['minima'] = True
-        minima_df = oc_df.merge(min_combined, on=['timestamp', 'underlying', 'expiry', 'combined_premium'], how='left')
-        minima_df['minima'].fillna(False, inplace=True)
-        # oc_df['minima'] = oc_df['combined_premium'] == min_combined
-
-        req_cols = ['timestamp', 'underlying', 'expiry', 'strike', 'symbol_c', 'symbol_p', 'spot_c', 'ltp_c', 'ltp_p',
-                    'oi_c', 'oi_p', 'iv_c', 'iv_p', 'combined_premium', 'combined_iv', 'otm_iv', 'minima']
-        req_straddle_df = minima_df[req_cols].copy()
-        cols_renames = {'symbol_c': 'call', 'symbol_p': 'put', 'spot_c': 'spot', 'ltp_c': 'call_price',
-                        'ltp_p': 'put_price', 'oi_c': 'call_oi', 'oi_p': 'put_oi', 'iv_c': 'call_iv', 'iv_p': 'put_iv'}
-        req_straddle_df.rename(columns=cols_renames, inplace=True)
-        if self.insert:
+        otm_iv = np.where(keys['strike'].to_numpy() > implied_atm, iv_c, iv_p)
+        # Minimum combined premium of every (underlying, expiry) run, NaN when it has none
+        starts = np.flatnonzero(np.diff(gid, prepend=-1))
+        group_min = np.fmin.reduceat(combined_premium, starts) if len(starts) else np.array([])
+        run_min = np.repeat(group_min, np.diff(np.append(starts, len(gid))))
+        minima = (combined_premium == run_min) | (np.isnan(combined_premium) & np.isnan(run_min))
+
+        req_straddle_df = pd.DataFrame({
+            'timestamp': df['timestamp'].iloc[0] if len(df) else pd.NaT,
+            'underlying': keys['underlying'], 'expiry': keys['expiry'], 'strike': keys['strike'],
+            'call': legs['symbol_c'], 'put': legs['symbol_p'], 'spot': legs['spot_c'], 'call_price': ltp_c,
+            'put_price': ltp_p, 'call_oi': legs['oi_c'], 'put_oi': legs['oi_p'], 'call_iv': iv_c, 'put_iv': iv_p,
+            'combined_premium': combined_premium, 'combined_iv': combined_iv, 'otm_iv': otm_iv, 'minima': minima})
+        req_straddle_df.insert(1, 'exchange_ts', watermark)
+        if self.insert if insert is None else insert:
             # insert req_straddle_df
             DBHandler.insert_opt_straddle(req_straddle_df.replace({np.NAN: None}).to_dict('records'))
         return req_straddle_df
 
-    @staticmethod
-    def get_ltp(symbol: str, xref: dict):
-        return xref.get(symbol, {}).get('last_price', None)
+    def slot_positions(self, entities) -> np.ndarray:
+        """Quote slot of every entity, -1 for entities not quoted"""
+        return np.array([self.entity_slot.get(_entity, -1) for _entity in entities], dtype=np.int64)
 
     @staticmethod
-    def get_oi(symbol: str, xref: dict):
-        return xref.get(symbol, {}).get('oi', None)
+    def gather(values: np.ndarray, pos: np.ndarray) -> np.ndarray:
+        """values at slot positions, NaN at -1"""
+        return np.append(values, np.nan)[pos]
+
+    def snap_columns(self, snap: dict) -> dict:
+        """Quote table snapshot as is, an entity dict laid out once in the same slot order"""
+        if isinstance(snap.get('last_price', None), np.ndarray):
+            return snap
+        quotes = [snap.get(_entity, None) or {} for _entity in self.entity_slot]
+        return {_field: np.array([np.nan if _quote.get(_field, None) is None else _quote[_field] for _quote in quotes],
+                                 dtype=float) for _field in ('last_price', 'oi')}
 
 
-def start_analysis(ins_df, tokens, token_xref, shared_xref):
+def start_analysis(universe: ContractUniverse, shared_xref, **kwargs):
     try:
-        SnapAnalysis(ins_df, tokens, token_xref, shared_xref, use_forward_fut=True, rate=0)
+        SnapAnalysis(universe, shared_xref, use_forward_fut=True, rate=0, use_vectorized=True, **kwargs)
 
         while True:
             sleep(10)
@@ -9,7 +9,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 
 from common import IST, yesterday, today, logger, fixed_response_dict, round_spot, read_symbols
-from contracts import get_req_contracts
+from contracts import get_universe
 from db_ops import DBHandler
 
 
@@ -23,6 +23,7 @@ class ServiceApp:
 
         self.add_routes()
         self.symbol_expiry_map = None
+        self.universe = None  # ContractUniverse behind symbol_expiry_map
         self.use_otm_iv = True
         self.copy_symbol_expiry_map = None
         self.copy_symbol_expiry_spot = None
@@ -35,6 +36,7 @@ class ServiceApp:
         self.app.add_api_route('/straddle/minima', methods=['GET'], endpoint=self.fetch_straddle_minima)
         self.app.add_api_route('/straddle/minima/table', methods=['GET'],
                                endpoint=self.fetch_straddle_minima_table)  # NEW
+        self.app.add_api_route('/straddle/live', methods=['GET'], endpoint=self.fetch_straddle_live)
         self.app.add_api_route('/straddle/iv', methods=['GET'], endpoint=self.fetch_straddle_iv)
         self.app.add_api_route('/straddle/cluster', methods=['GET'], endpoint=self.fetch_straddle_cluster)
         self.app.add_api_route('/login', methods=['POST'], endpoint=self.userLogin)
@@ -76,14 +78,10 @@ class ServiceApp:
             return {"msg": True, "output": "login failure"}
 
     def get_symbols(self):
-        if self.symbol_expiry_map is None:
-            ins_df, tokens, token_xref = get_req_contracts()
-            ins_df['expiry'] = ins_df['expiry'].dt.strftime('%Y-%m-%d')
-            agg = ins_df[ins_df['instrument_type'].isin(['CE', 'PE'])].groupby(['name'], as_index=False).agg({'expiry': set, 'tradingsymbol': 'count'})
-            agg['expiry'] = agg['expiry'].apply(lambda x: sorted(list(x)))
-            self.symbol_expiry_map = agg.to_dict('records')
-            symbol_expiry_map = agg.to_dict('records')
-            logger.info(f'\n symbol expiry map is \n{symbol_expiry_map} \n and type is {type(symbol_expiry_map)}')
+        if self.symbol_expiry_map is None or not self.universe.is_valid():
+            self.universe = get_universe()
+            self.symbol_expiry_map = [dict(_row) for _row in self.universe.symbol_expiries]
+            logger.info(f'\n symbol expiry map is \n{self.symbol_expiry_map} \n and type is {type(self.symbol_expiry_map)}')
             self.copy_symbol_expiry_map = self.symbol_expiry_map.copy()
         return self.symbol_expiry_map
 
@@ -259,6 +257,14 @@ class ServiceApp:
                     ]
                 return empty_json
 
+    def fetch_straddle_live(self, symbol: str = Query(), expiry: date = Query()):
+        # Minima of the latest analysis run, refreshed every calc_secs while the charts' minute rows are persisted
+        df = DBHandler.get_straddle_live(symbol, expiry)
+        df['ts'] = pd.to_datetime(df['ts'])
+        if self.use_otm_iv:
+            df['combined_iv'] = df['otm_iv']
+        return self.df_response(df, to_millis=['ts'])
+
     def fetch_straddle_iv(self, symbol: str = Query(), expiry: date = Query(), st_cnt: int = Query(default=None),
                           interval: int = Query(5)):
         df = DBHandler.get_straddle_iv_data(symbol, expiry)
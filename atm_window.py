@@ -0,0 +1,130 @@
+from threading import Thread, Event
+
+import numpy as np
+import pandas as pd
+
+import xts_main
+from common import logger
+
+opt_types = ['CE', 'PE']
+
+
+class AtmWindow:
+    """
+    Keeps only a window of strikes around the ATM subscribed for every (underlying, expiry), following the live spot
+    (or the near future before the spot ticks). A chain is recentred only once the ATM strike has moved more than
+    `hysteresis` strikes off the window's centre, then the strikes entering the window are subscribed and the ones
+    leaving it unsubscribed on the account the instrument was sharded to. Underlyings and futures stay subscribed.
+    Quote slots of unsubscribed strikes are cleared, so the analysis never prices a stale quote.
+    """
+
+    def __init__(self, ins_df_list: list, access_tokens: list, headers: dict, shared_xref, **kwargs):
+        """
+        :param ins_df_list: instruments sharded per account, see xts_main.split_into_tokens
+        :param shared_xref: QuoteTable handle bound to a writer lane of its own, see QuoteTable.writer
+        :param kwargs: window (strikes each side of the ATM), hysteresis (strikes), interval (secs)
+        """
+        self.access_tokens = access_tokens
+        self.headers = headers
+        self.shared_xref = shared_xref
+        self.window = kwargs.get('window', 20)
+        self.hysteresis = kwargs.get('hysteresis', 3)
+        self.interval = kwargs.get('interval', 5)
+
+        ins = pd.concat([_df.assign(account=_i) for _i, _df in enumerate(ins_df_list)])
+        is_opt = ins['instrument_type'].isin(opt_types)
+        self.ins = ins
+        self.static = ins[~is_opt]  # always subscribed
+        self.chains = {}
+        futures = ins[ins['instrument_type'] == 'FUT'].sort_values('expiry')
+        for (_name, _expiry), _chain in ins[is_opt].groupby(['name', 'expiry']):
+            strikes = np.unique(_chain['strike'].to_numpy(dtype=float))
+            _futures = futures[futures['name'] == _name]
+            self.chains[(_name, _expiry)] = {
+                'strikes': strikes,
+                'rows': _chain,
+                'spot_slot': shared_xref.entity_slot.get(_name, None),
+                'fut_slot': shared_xref.token_slot.get(_futures['instrument_token'].iloc[0], None)
+                if len(_futures) else None,
+                'centre': len(strikes) // 2,  # median strike until the first spot, the strike grid is near symmetric
+            }
+        self.subscribed = set()  # option rows (ins index) subscribed
+        self._stop = Event()
+        self._th = None
+
+    def _window_rows(self, chain: dict, centre: int) -> set:
+        strikes, rows = chain['strikes'], chain['rows']
+        lo = strikes[max(centre - self.window, 0)]
+        hi = strikes[min(centre + self.window, len(strikes) - 1)]
+        return set(rows.index[(rows['strike'] >= lo) & (rows['strike'] <= hi)])
+
+    def _split(self, rows) -> list:
+        df = rows if isinstance(rows, pd.DataFrame) else self.ins.loc[sorted(rows)]
+        return [df[df['account'] == _i] for _i in range(len(self.access_tokens))]
+
+    def initial(self) -> list:
+        """Instruments to subscribe at start, per account: underlyings, futures and the window of every chain"""
+        for _chain in self.chains.values():
+            self.subscribed |= self._window_rows(_chain, _chain['centre'])
+        logger.info(f'ATM window: {len(self.subscribed)} of {len(self.ins) - len(self.static)} options subscribed '
+                    f'across {len(self.chains)} chains')
+        return self._split(pd.concat([self.static, self.ins.loc[sorted(self.subscribed)]]))
+
+    def atm_index(self, chain: dict, snap: dict):
+        """Index of the strike nearest the live spot (or future), None before either ticks"""
+        price = np.nan
+        for _slot in (chain['spot_slot'], chain['fut_slot']):
+            if _slot is not None and not np.isnan(snap['last_price'][_slot]):
+                price = snap['last_price'][_slot]
+                break
+        if np.isnan(price):
+            return None
+        strikes = chain['strikes']
+        mid = (strikes[1:] + strikes[:-1]) / 2  # nearest strike, ties to the higher one
+        return int(np.searchsorted(mid, price, side='right'))
+
+    def rebalance(self):
+        """Recentre the chains whose ATM left the hysteresis band, then (un)subscribe the difference"""
+        snap = self.shared_xref.snapshot()
+        wanted = set(self.subscribed)
+        for _key, _chain in self.chains.items():
+            atm = self.atm_index(_chain, snap)
+            if atm is None or abs(atm - _chain['centre']) <= self.hysteresis:
+                continue
+            logger.info(f'ATM window {_key[0]} {_key[1]:%Y-%m-%d} recentred on {_chain["strikes"][atm]}')
+            wanted -= self._window_rows(_chain, _chain['centre'])
+            wanted |= self._window_rows(_chain, atm)
+            _chain['centre'] = atm
+        added, removed = wanted - self.subscribed, self.subscribed - wanted
+        if added:
+            report = xts_main.subscribe_init(self.access_tokens, self.headers, 'subs', self._split(added))
+            self.subscribed |= self._done(added, report)
+        if removed:
+            report = xts_main.subscribe_init(self.access_tokens, self.headers, 'unsubs', self._split(removed))
+            removed = self._done(removed, report)
+            self.subscribed -= removed
+            slots = [self.shared_xref.token_slot[_token] for _token in self.ins.loc[sorted(removed), 'instrument_token']]
+            self.shared_xref.clear(slots)
+        return added, removed
+
+    def _done(self, rows: set, report: pd.DataFrame) -> set:
+        """Rows whose market data request went through"""
+        ok = report[report['success'] & (report['xts_message_code'] == 1502)]['exchange_instrument_id']
+        tokens = self.ins.loc[sorted(rows), 'exchange_token'].astype(int)
+        return set(tokens.index[tokens.isin(set(ok))])
+
+    def start(self):
+        self._th = Thread(target=self._run, daemon=True, name='ATM Window')
+        self._th.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._th is not None:
+            self._th.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.rebalance()
+            except Exception as exc:
+                logger.error(f'Error in ATM window: {exc}')
@@ -7,6 +7,7 @@ from time import time
 import pandas as pd
 import requests
 import csv
+from dateutil.relativedelta import relativedelta
 
 from common import logger, instruments_path, today, root_dir, data_dir, read_symbols
 from update_expiry import update_expiry
@@ -84,6 +85,75 @@ def get_req_contracts():
     return req, tokens, token_xref
 
 
+class ContractUniverse:
+    """
+    Required contracts of the day (see get_req_contracts) with the views every consumer derives from them,
+    computed once on load. Loaded once per process by get_universe() and passed on explicitly; it pickles with its frames,
+    so spawned workers receive it instead of reloading instruments.csv, symbols.xlsx and the master.
+    """
+
+    def __init__(self, ins_df: pd.DataFrame, day=None):
+        self.ins_df = ins_df
+        self.day = pd.Timestamp(datetime.now() if day is None else day).normalize()  # Valid on the day loaded only
+        self.tokens = ins_df['instrument_token'].tolist()
+        self.token_xref = ins_df[['instrument_token', 'tradingsymbol']].set_index('instrument_token').to_dict()['tradingsymbol']
+        self.entity_xref = {_entity: _token for _token, _entity in self.token_xref.items()}
+        self.opt_df = self.options(ins_df)
+        self.fut_map = self.futures(ins_df)
+        self.symbol_expiries = self.expiries(ins_df)
+
+    @classmethod
+    def load(cls):
+        ins_df, _, _ = get_req_contracts()
+        universe = cls(ins_df)
+        logger.info(f'Contract universe of {universe.day:%Y-%m-%d}: {len(universe.tokens)} contracts')
+        return universe
+
+    def is_valid(self, day=None) -> bool:
+        day = pd.Timestamp(datetime.now() if day is None else day).normalize()
+        return self.day == day
+
+    def __iter__(self):
+        """Unpacks like get_req_contracts: ins_df, tokens, token_xref"""
+        return iter((self.ins_df, self.tokens, self.token_xref))
+
+    @staticmethod
+    def options(ins_df: pd.DataFrame) -> pd.DataFrame:
+        """Options as symbol, underlying, expiry (at 15:30), strike, opt"""
+        meta_df: pd.DataFrame = ins_df[ins_df['segment'] == 'NFO-OPT']
+        renames = {'tradingsymbol': 'symbol', 'name': 'underlying', 'instrument_type': 'opt'}
+        opt_df = meta_df[['tradingsymbol', 'name', 'expiry', 'strike', 'instrument_type']].copy().rename(columns=renames)
+        opt_df['expiry'] = opt_df['expiry'].apply(lambda x: x + relativedelta(hour=15, minute=30))
+        return opt_df.reset_index(drop=True)
+
+    @staticmethod
+    def futures(ins_df: pd.DataFrame) -> dict:
+        """Underlying -> future. With several futures listed, the latest expiry wins, as SnapAnalysis always had it"""
+        fut_df: pd.DataFrame = ins_df[ins_df['segment'] == 'NFO-FUT']
+        req_fut = fut_df.sort_values('expiry')[['tradingsymbol', 'name']].drop_duplicates(keep='first')
+        return req_fut.set_index('name').to_dict()['tradingsymbol']
+
+    @staticmethod
+    def expiries(ins_df: pd.DataFrame) -> list:
+        """Option expiries (YYYY-MM-DD, sorted) and contract count of every underlying"""
+        opt = ins_df[ins_df['instrument_type'].isin(['CE', 'PE'])]
+        agg = opt.assign(expiry=opt['expiry'].dt.strftime('%Y-%m-%d')).groupby(['name'], as_index=False).agg(
+            {'expiry': set, 'tradingsymbol': 'count'})
+        agg['expiry'] = agg['expiry'].apply(lambda x: sorted(list(x)))
+        return agg.to_dict('records')
+
+
+_universe: ContractUniverse = None
+
+
+def get_universe(force=False) -> ContractUniverse:
+    """The process' contract universe, reloaded only once the day it was loaded for has passed"""
+    global _universe
+    if force or _universe is None or not _universe.is_valid():
+        _universe = ContractUniverse.load()
+    return _universe
+
+
 def entity_expiry():
     # symbols = pd.read_excel(os.path.join(root_dir, 'symbols.xlsx'))
     symbols = read_symbols
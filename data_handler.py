@@ -1,25 +1,113 @@
+import os
 import traceback
-from datetime import datetime, timedelta
+from bisect import bisect_right
 from functools import cached_property
-from queue import Queue
+from queue import Queue, Empty
+from struct import pack, pack_into, unpack_from
 from threading import Thread
-from time import sleep
+from time import time, gmtime, strftime
 
+import numpy as np
+import pandas as pd
 import psutil
 
-from common import logger
-
-
-epoch_to_datetime = lambda epoch_time: datetime.combine(datetime.today().date(), (datetime.fromtimestamp(epoch_time) - timedelta(hours=5, minutes=30)).time())
+from common import logger, data_dir
+from quote_table import QuoteTable
+
+
+ist_offset = 19800  # secs
+xts_epoch_offset = 315532800 - ist_offset  # XTS timestamps count IST wall-clock seconds from 1980-01-01
+
+feed_sentinel = None  # Queued to shut a processor down, feeds are always lists. Piped as an empty message
+# Tick record piped from DataHandler to CandleCreator. slot indexes the QuoteTable, ts is the exchange time in epoch ms
+tick_dtype = np.dtype([('slot', 'i4'), ('ts', 'i8'), ('ltp', 'f8'), ('ltq', 'f8'), ('volume', 'f8'), ('oi', 'f8')])
+tick_header = 8  # Leading send time (float64 epoch secs) of every tick batch
+latency_edges = [0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 250, 1000]  # ms
+batch_edges = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+
+
+session_open = (9 * 60 + 15) * 60  # 09:15 IST, secs of day
+session_minutes = 376  # 09:15 to 15:30, both inclusive
+minute_keys = [f'{_m // 60:02d}{_m % 60:02d}' for _m in range(session_open // 60, session_open // 60 + session_minutes)]
+# Minute bar sent on the candle pipe. minute is the session minute index, 0 for 09:15
+candle_dtype = np.dtype([('slot', 'i4'), ('minute', 'i2'), ('open', 'f8'), ('high', 'f8'), ('low', 'f8'),
+                         ('close', 'f8'), ('volume', 'f8'), ('oi', 'f8')])
+tick_counts_dir = os.path.join(data_dir, 'tick_counts')  # ticks per entity of past sessions, one file per creator
+# Tick journal record, the tick with its instrument token and local receive time (epoch secs)
+journal_dtype = np.dtype([('token', 'i8'), ('recv_ts', 'f8'), ('ts', 'i8'), ('ltp', 'f8'), ('ltq', 'f8'),
+                          ('volume', 'f8'), ('oi', 'f8')])
+journal_header = 16
+journal_dir = os.path.join(data_dir, 'journal')
+
+
+class Histogram:
+    """Fixed bucket counts, each bucket holds values <= its edge and above the previous one"""
+
+    def __init__(self, edges: list):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect_right(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def summary(self):
+        labels = [f'<={_edge}' for _edge in self.edges] + [f'>{self.edges[-1]}']
+        return {'count': self.count, 'mean': round(self.total / self.count, 3) if self.count else None,
+                'max': round(self.max, 3), 'buckets': {_l: _c for _l, _c in zip(labels, self.counts) if _c}}
+
+
+def drain_queue(queue: Queue, max_items, max_ms, timeout):
+    """
+    Block up to `timeout` secs for the first item, then take whatever else is already queued, up to `max_items` or
+    `max_ms` of draining.
+    :return: (items, stop) where stop is True once the sentinel was taken
+    """
+    try:
+        item = queue.get(timeout=timeout)
+    except Empty:
+        return [], False
+    items = []
+    deadline = time() + max_ms / 1000
+    while item is not feed_sentinel:
+        items.append(item)
+        if len(items) >= max_items or time() >= deadline:
+            return items, False
+        try:
+            item = queue.get_nowait()
+        except Empty:
+            return items, False
+    return items, True
 
 
 class DataHandler:
-    def __init__(self, sender=None) -> None:
+    def __init__(self, sender=None, token_xref=None, mode='zerodha', **kwargs) -> None:
         super().__init__()
         self.queue = Queue()
         self.processor_thread = None
-        self._kill = False
         self.sender = sender if sender is not None else None
+        self.mode = mode
+        self.token_slot = QuoteTable.slots(token_xref or {})  # token -> slot
+        self.entity_slot = {token_xref[_token]: _slot for _token, _slot in self.token_slot.items()}  # entity -> slot
+        self.batch_size = kwargs.get('batch_size', 500)  # Max queued feeds forwarded as one batch
+        self.batch_ms = kwargs.get('batch_ms', 5)  # Max time spent collecting a batch
+        self.stats_interval = kwargs.get('stats_interval', 60)  # secs
+        # Keep only the first, highest, lowest and newest tick per instrument and flush every conflate_ms, so minute
+        # bars keep their open/high/low/close. 0 forwards every tick. Never conflated across an exchange minute
+        self.conflate_ms = kwargs.get('conflate_ms', 0)
+        self.latency_hist = Histogram(latency_edges)  # receiver -> processor, ms
+        self.batch_hist = Histogram(batch_edges)  # ticks per forwarded batch
+        self.conflated = 0  # ticks dropped within an instrument's conflation window
+        self._pending = {}  # slot -> [received, first, high, low, newest] since the last flush, ticks as (nth, tick)
+        self._last_flush = time()
+        # Every decoded tick to the day's journal when set, see TickJournal
+        self.journal = TickJournal(list(self.token_slot), name=kwargs.get('name', mode)) \
+            if kwargs.get('journal', False) else None
 
     @cached_property
     def _do_send(self):
@@ -32,33 +120,329 @@ class DataHandler:
         self.processor_thread = th
 
     def stop_processor(self):
-        self._kill = True
+        self.queue.put(feed_sentinel)
         if self.processor_thread is not None:
             self.processor_thread.join()
-        logger.info('Data Handler Exits')
+        if self.journal is not None:
+            self.journal.close()
+        logger.info(f'Data Handler Exits. Stats: {self.stats()}')
 
     def receiver(self, data):
-        self.queue.put(data)
+        self.queue.put((time(), data))
+
+    def stats(self):
+        return {'latency_ms': self.latency_hist.summary(), 'batch_size': self.batch_hist.summary(),
+                'conflated': self.conflated}
 
     def _data_processor(self):
+        last_stats = time()
+        timeout = min(1, self.conflate_ms / 1000) if self.conflate_ms else 1
         while True:
-            if self.queue.qsize() > 0:
-                _feed = self.queue.get()
-                # Change the feed format here
-                _f_feed = _feed
-                # logger.info(f'Data Handler: {len(_feed)}')
-                # Send the feed after formatting, if required
-                if self._do_send:
-                    self.sender.send(_f_feed)
-                else:
-                    logger.debug(_f_feed)
-            else:
-                sleep(0.07)
+            batch, stop = drain_queue(self.queue, self.batch_size, self.batch_ms, timeout=timeout)
+            now = time()
+            for _ts, _feed in batch:
+                self.latency_hist.add((now - _ts) * 1000)
+            self.push_ticks(self.extract_ticks(batch), now, flush=stop)
 
-            if self._kill is True:
+            if stop:
+                if self._do_send:
+                    self.sender.send_bytes(b'')
                 break
+            if now - last_stats >= self.stats_interval:
+                logger.info(f'Data Handler stats: {self.stats()}')
+                last_stats = now
         logger.debug(f'Data Processor Exit')
 
+    def push_ticks(self, ticks: list, now, flush=False):
+        """Journal, conflate (if set) and forward extracted tick tuples"""
+        if self.conflate_ms:
+            if self.journal is not None and ticks:
+                self.journal.append(np.array(ticks, dtype=tick_dtype), now)
+            ticks = self.conflate(ticks, now, flush=flush)
+            self._forward(ticks, now)
+        else:
+            payload = self._forward(ticks, now)
+            # Unconflated, the forwarded batch is every tick: journal its packed records
+            if self.journal is not None and payload is not None:
+                self.journal.append(unpack_ticks(payload)[1], now)
+
+    def _forward(self, ticks: list, now):
+        if not ticks:
+            return None
+        self.batch_hist.add(len(ticks))
+        payload = pack_ticks(ticks, now)
+        # Send the feed after formatting, if required
+        if self._do_send:
+            self.sender.send_bytes(payload)
+        else:
+            logger.debug(unpack_ticks(payload)[1])
+        return payload
+
+    def extract_ticks(self, batch) -> list:
+        ticks = []
+        for _, _feed in batch:
+            for _e_feed in _feed:
+                try:
+                    ticks.append(self._extract_connector_feed(_e_feed))
+                except Exception as exc:
+                    logger.error(f'Error while processing feed: {exc}')
+        return ticks
+
+    def conflate(self, ticks: list, now, flush=False) -> list:
+        """
+        Hold the first, highest, lowest and newest tick per slot, returning what is due to be forwarded: the held ticks
+        of every slot once conflate_ms has passed since the last flush, plus those of a slot superseded by a tick of a
+        later exchange minute. A slot's ticks are forwarded in the order received.
+        """
+        due = []
+        for _tick in ticks:
+            _held = self._pending.get(_tick[0], None)
+            if _held is not None and _held[4][1][1] // 60000 == _tick[1] // 60000:
+                _held[0] += 1
+                _entry = (_held[0], _tick)
+                if _tick[2] > _held[2][1][2]:
+                    _held[2] = _entry
+                elif _tick[2] < _held[3][1][2]:
+                    _held[3] = _entry
+                _held[4] = _entry
+                continue
+            if _held is not None:
+                due.extend(self._held_ticks(_held))
+            _entry = (1, _tick)
+            self._pending[_tick[0]] = [1, _entry, _entry, _entry, _entry]
+        if flush or (now - self._last_flush) * 1000 >= self.conflate_ms:
+            for _held in self._pending.values():
+                due.extend(self._held_ticks(_held))
+            self._pending.clear()
+            self._last_flush = now
+        return due
+
+    def _held_ticks(self, held: list) -> list:
+        """Distinct held ticks of a slot in the order received, counting the rest as conflated"""
+        ticks = dict(sorted(held[1:]))
+        self.conflated += held[0] - len(ticks)
+        return list(ticks.values())
+
+    def _extract_connector_feed(self, entity_feed):
+        if self.mode == 'zerodha':
+            return self._extract_feed_v4(entity_feed)
+        elif self.mode == 'xts':
+            return self._extract_feed_xts(entity_feed)
+        else:
+            raise ValueError('feed mode not understood')
+
+    def _extract_feed_v4(self, entity_feed):
+        keys = entity_feed.keys()
+        # slot, ts, last_price, ltq, cum_vol, oi
+        return (self.token_slot[entity_feed['instrument_token']],
+                int(entity_feed['exchange_timestamp'].timestamp() * 1000),
+                entity_feed['last_price'],
+                entity_feed['last_traded_quantity'] if 'last_traded_quantity' in keys else 0,  # For Index
+                entity_feed['volume_traded'] if 'volume_traded' in keys else 0,  # For Index
+                entity_feed['oi'] if 'oi' in keys else 0)  # For Index
+
+    def _extract_feed_xts(self, entity_feed):
+        # logger.info(f"extract {entity_feed}")
+        touchline = entity_feed.get('Touchline', {})
+        return (self.entity_slot[entity_feed['entity']], (entity_feed['ExchangeTimeStamp'] + xts_epoch_offset) * 1000,
+                touchline['LastTradedPrice'], touchline.get('LastTradedQunatity', 0),
+                touchline.get('TotalTradedQuantity', 0), entity_feed.get('oi', 0))
+
+
+class CandleBook:
+    """
+    Minute OHLCV+OI bars of the session for every quote slot, held in preallocated (slots x session minutes) arrays
+    and updated in place a tick batch at a time. Volume is the bar's share of the cumulative traded volume.
+    """
+
+    def __init__(self, n_slots):
+        shape = (n_slots, session_minutes)
+        self.open = np.full(shape, np.nan)
+        self.high = np.full(shape, np.nan)
+        self.low = np.full(shape, np.nan)
+        self.close = np.full(shape, np.nan)
+        self.volume = np.zeros(shape)
+        self.oi = np.full(shape, np.nan)
+        self.last_volume = np.full(n_slots, np.nan)  # cumulative volume at the latest tick of the slot
+        self.ticks = np.zeros(n_slots, dtype=np.int64)  # in-session ticks per slot
+        self.current = -1  # latest session minute seen
+        self.completed = -1  # minutes before this one are complete and handed out
+        self.dropped = 0  # ticks outside the session
+        self.late = 0  # ticks for a minute already handed out
+        self.day_start = None  # epoch secs of the session day's IST midnight, set by the first tick
+
+    @staticmethod
+    def day_of(ts):
+        """Epoch secs of the IST midnight starting the day of an exchange time in epoch ms"""
+        return (int(ts) // 1000 + ist_offset) // 86400 * 86400 - ist_offset
+
+    def minute_index(self, ts):
+        """Session minute of exchange times in epoch ms, integer arithmetic against the day's start"""
+        return (ts // 1000 - (self.day_start + session_open)) // 60
+
+    def update(self, ticks: np.ndarray) -> list:
+        """
+        Fold a tick_dtype batch into the bars.
+        :return: minutes completed by this batch, i.e. earlier than the latest minute seen so far
+        """
+        if not len(ticks):
+            return []
+        latest_day = self.day_of(ticks['ts'].max())
+        if self.day_start is None:
+            self.day_start = latest_day
+        elif latest_day > self.day_start:
+            logger.info(f'Candle book rolls over to a new session day')
+            self.__init__(len(self.last_volume))
+            self.day_start = latest_day
+        minute = self.minute_index(ticks['ts'])
+        valid = (minute >= 0) & (minute < session_minutes) & ~np.isnan(ticks['ltp'])
+        self.dropped += int((~valid).sum())
+        # Every tick moves the cumulative volume baseline, pre-open ones included
+        self._add_volume(ticks['slot'], minute, ticks['volume'], valid)
+        ticks, minute = ticks[valid], minute[valid]
+        if not len(ticks):
+            return []
+        slot, ltp = ticks['slot'], ticks['ltp']
+        self.ticks += np.bincount(slot, minlength=len(self.ticks))
+        self.late += int((minute < self.completed).sum())
+
+        # Fancy assignment gives no order guarantee on repeated bars, so open/close/oi take explicit first/last ticks
+        bar = slot * session_minutes + minute  # Flat index into the (slots x minutes) arrays
+        first, last = self._first_last(bar)
+        new_bar = np.isnan(self.open.flat[bar[first]])
+        self.open.flat[bar[first][new_bar]] = ltp[first][new_bar]
+        self.close.flat[bar[last]] = ltp[last]
+        np.fmax.at(self.high.reshape(-1), bar, ltp)
+        np.fmin.at(self.low.reshape(-1), bar, ltp)
+        has_oi = np.flatnonzero(~np.isnan(ticks['oi']))
+        _, last_oi = self._first_last(bar[has_oi])
+        self.oi.flat[bar[has_oi][last_oi]] = ticks['oi'][has_oi][last_oi]
+
+        if self.completed < 0:
+            self.completed = int(minute.min())
+        self.current = max(self.current, int(minute.max()))
+        done = list(range(self.completed, self.current))
+        self.completed = max(self.completed, self.current)
+        return done
+
+    @staticmethod
+    def _first_last(keys):
+        """Positions of the first and of the last occurrence of every distinct key"""
+        _, first = np.unique(keys, return_index=True)
+        _, last = np.unique(keys[::-1], return_index=True)
+        return first, len(keys) - 1 - last
+
+    def _add_volume(self, slot, minute, cum_volume, valid):
+        has_volume = ~np.isnan(cum_volume)
+        slot, minute, cum_volume, valid = slot[has_volume], minute[has_volume], cum_volume[has_volume], valid[has_volume]
+        if not len(slot):
+            return
+        order = np.argsort(slot, kind='stable')
+        slot, minute, cum_volume, valid = slot[order], minute[order], cum_volume[order], valid[order]
+        first = np.ones(len(slot), dtype=bool)
+        first[1:] = slot[1:] != slot[:-1]
+        prev = np.empty_like(cum_volume)
+        prev[1:] = cum_volume[:-1]
+        prev[first] = self.last_volume[slot[first]]
+        traded = cum_volume - prev
+        traded[np.isnan(traded) | (traded < 0)] = 0
+        np.add.at(self.volume, (slot[valid], minute[valid]), traded[valid])
+        last = np.ones(len(slot), dtype=bool)
+        last[:-1] = first[1:]
+        self.last_volume[slot[last]] = cum_volume[last]
+
+    def bars(self, minute) -> np.ndarray:
+        """candle_dtype records of every slot that traded in the minute"""
+        slots = np.flatnonzero(~np.isnan(self.open[:, minute]))
+        bars = np.empty(len(slots), dtype=candle_dtype)
+        bars['slot'] = slots
+        bars['minute'] = minute
+        for _field in ['open', 'high', 'low', 'close', 'volume', 'oi']:
+            bars[_field] = getattr(self, _field)[slots, minute]
+        return bars
+
+
+def pack_ticks(ticks: list, sent_at):
+    """One contiguous buffer: the send time followed by a tick_dtype record per tick tuple"""
+    payload = bytearray(tick_header + len(ticks) * tick_dtype.itemsize)
+    pack_into('d', payload, 0, sent_at)
+    if ticks:
+        np.frombuffer(payload, dtype=tick_dtype, offset=tick_header)[:] = ticks
+    return payload
+
+
+def unpack_ticks(payload):
+    """:return: (send time, tick_dtype records) of a packed tick batch, records are a read-only view of payload"""
+    return unpack_from('d', payload)[0], np.frombuffer(payload, dtype=tick_dtype, offset=tick_header)
+
+
+class TickJournal:
+    """
+    Append-only record of every decoded tick, one file per session day and writer under data_dir/journal, as
+    fixed-width journal_dtype records behind a 16 byte header. A batch is a single buffered write of its records; a
+    record torn by a crash mid-write is left out by read_journal. Tokens, not slots, are recorded so a journal
+    replays against any token_xref.
+    """
+    magic = b'TICKJRN1'
+
+    def __init__(self, tokens: list, name='sock', directory=None):
+        self.tokens = np.asarray(tokens, dtype=np.int64)  # slot -> token
+        self.name = name
+        self.directory = journal_dir if directory is None else directory
+        self.day = None
+        self.path = None
+        self.records = 0
+        self.flush_secs = 1  # bounds the ticks lost with the process
+        self._file = None
+        self._last_flush = 0
+        self._day_start = 0  # epoch secs of the IST midnight of the open file's day
+
+    def _open(self, day):
+        self.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self.day = day
+        self.path = os.path.join(self.directory, f'{day}_{self.name}.ticks')
+        is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self._file = open(self.path, 'ab', buffering=1 << 20)
+        if is_new:
+            self._file.write(self.magic + pack('q', journal_dtype.itemsize))
+        logger.info(f'Tick journal at {self.path}')
+
+    def append(self, ticks: np.ndarray, recv_ts):
+        """:param ticks: tick_dtype records received at recv_ts"""
+        if not len(ticks):
+            return
+        if not self._day_start <= recv_ts < self._day_start + 86400:
+            self._day_start = (int(recv_ts) + ist_offset) // 86400 * 86400 - ist_offset
+            self._open(strftime('%Y%m%d', gmtime(self._day_start + ist_offset)))
+        records = np.empty(len(ticks), dtype=journal_dtype)
+        records['token'] = self.tokens[ticks['slot']]
+        records['recv_ts'] = recv_ts
+        for _field in ('ts', 'ltp', 'ltq', 'volume', 'oi'):
+            records[_field] = ticks[_field]
+        self._file.write(records.tobytes())
+        self.records += len(records)
+        if recv_ts - self._last_flush >= self.flush_secs:
+            self._file.flush()
+            self._last_flush = recv_ts
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_journal(path) -> np.ndarray:
+    """Memory map of the whole records of a journal file, read-only"""
+    with open(path, 'rb') as f:
+        header = f.read(journal_header)
+    if header[:8] != TickJournal.magic or unpack_from('q', header, 8)[0] != journal_dtype.itemsize:
+        raise ValueError(f'{path} is not a tick journal of this record format')
+    n_records = (os.path.getsize(path) - journal_header) // journal_dtype.itemsize
+    if not n_records:
+        return np.empty(0, dtype=journal_dtype)
+    return np.memmap(path, dtype=journal_dtype, mode='r', offset=journal_header, shape=(n_records,))
+
 
 class CandleCreator:
 
@@ -79,19 +463,25 @@ class CandleCreator:
         self.entity_xref = {_v: _k for _k, _v in token_xref.items()}  # entity -> token
         self.entities = list(self.token_xref.values())
         self.scrip_xref = {_scrip.entity: _scrip for _scrip in self.scrips}
-        self.shared_xref = kwargs.get('shared_xref', {})
+        self.shared_xref = kwargs.get('shared_xref', None)  # QuoteTable
         self.name = kwargs.get('name', 'sock')
-        self.mode = kwargs.get('mode', 'zerodha')
 
         self.candle_sender = kwargs.get('c_sender', None)
+        self.candle_lock = kwargs.get('candle_lock', None)  # Guards the candle pipe shared by every creator
         self.daemon = kwargs.get('threaded', False)
+        self.candles = CandleBook(len(self.token_xref))
 
         self._token_vol = {_token: 0 for _token in self.tokens}
         self._recv_queue = Queue()  # Receiver Queue
         self._ltp_queue = Queue()  # LTP Queue
         self._redis_queue = Queue()
         self._candle_queue = Queue()  # Candle Queue
-        self._kill = False  # To initiate Kill all threads
+        self.batch_size = kwargs.get('batch_size', 500)
+        self.batch_ms = kwargs.get('batch_ms', 5)
+        self.stats_interval = kwargs.get('stats_interval', 60)  # secs
+        self.pipe_hist = Histogram(latency_edges)  # data handler -> receiver, ms
+        self.queue_hist = Histogram(latency_edges)  # receiver -> processor, ms
+        self.batch_hist = Histogram(batch_edges)  # ticks per processed batch
         self._th_receive = None
         self._th_process = None
         self._th_ltp = None
@@ -125,83 +515,124 @@ class CandleCreator:
 
     def stop_processor(self):
         logger.info(f'Candle Creator Stop initiated')
-        self._kill = True
+        if self._th_receive is not None:
+            # Exits on the sentinel piped by the data handler, after queueing every tick still in the pipe
+            self._th_receive.join(timeout=5)
+        self._recv_queue.put(feed_sentinel)
         if self._th_process is not None:
             self._th_process.join()
-        if self._th_receive is not None:
-            self._th_receive.join()
         if self._th_ltp is not None:
             self._th_ltp.join()
         if self._th_candle is not None:
             self._th_candle.join()
-        logger.info(f'Candle Creator Exits')
+        logger.info(f'Candle Creator Exits. Stats: {self.stats()}')
+
+    def wait(self):
+        """Block until the processor took the data handler's sentinel and sent the session's last bars"""
+        if self._th_receive is not None:
+            self._th_receive.join()
+        if self._th_process is not None:
+            self._th_process.join()
+        logger.info(f'Candle Creator {self.name} Exits. Stats: {self.stats()}')
+
+    def process_ticks(self, ticks: np.ndarray):
+        """Apply a tick_dtype batch to the quote table and the minute bars"""
+        self._update_shared_xref(ticks)
+        self._send_candles(self.candles.update(ticks))
+
+    def flush_candles(self):
+        """Send the bars still open, the session's last bar never sees a later minute"""
+        if self.candles.current >= self.candles.completed >= 0:
+            self._send_candles(range(self.candles.completed, self.candles.current + 1))
+            self.candles.completed = self.candles.current + 1
+
+    def dump_tick_counts(self):
+        """Session tick count of every ticked entity to data_dir, read back by load_tick_counts on the next day"""
+        if self.candles.day_start is None:
+            return
+        ticked = np.flatnonzero(self.candles.ticks)
+        day = strftime('%Y%m%d', gmtime(self.candles.day_start + ist_offset))
+        os.makedirs(tick_counts_dir, exist_ok=True)
+        path = os.path.join(tick_counts_dir, f'{day}_{self.name}.csv')
+        pd.DataFrame({'entity': [self.entities[_slot] for _slot in ticked],
+                      'ticks': self.candles.ticks[ticked]}).to_csv(path, index=False)
+        logger.info(f'Tick counts of {len(ticked)} entities dumped to {path}')
+
+    def stats(self):
+        return {'pipe_latency_ms': self.pipe_hist.summary(), 'queue_latency_ms': self.queue_hist.summary(),
+                'batch_size': self.batch_hist.summary(), 'ticks': int(self.candles.ticks.sum()),
+                'dropped_ticks': self.candles.dropped, 'late_ticks': self.candles.late}
+
+    def _send_candles(self, minutes):
+        for _minute in minutes:
+            _bars = self.candles.bars(_minute)
+            if not len(_bars) or not self.do_send:
+                continue
+            if self.candle_lock is not None:
+                with self.candle_lock:
+                    self.candle_sender.send_bytes(_bars)
+            else:
+                self.candle_sender.send_bytes(_bars)
 
     def _data_receiver(self):
         while True:
-            _feed = self.receiver.recv()
-            self._recv_queue.put(_feed)
-            if self._kill is True:
+            _msg = self.receiver.recv_bytes()
+            if not _msg:
+                self._recv_queue.put(feed_sentinel)
                 break
+            now = time()
+            _sent_at, _ticks = unpack_ticks(_msg)
+            self.pipe_hist.add((now - _sent_at) * 1000)
+            self._recv_queue.put((now, _ticks))
 
     # NOSONAR
     def _data_processor(self):
+        last_stats = time()
         while True:
-            try:
-                if self._recv_queue.qsize() > 0:
-                    _feed = self._recv_queue.get()
-                    # logger.info(f'Candle Creator: {len(_feed)}')
-                    if len(_feed) > 0:
-                        for _e_feed in _feed:
-                            _data, _xref_dict = self._extract_connector_feed(_e_feed)
-                            # self._ltp_queue.put(_data)
-                            self._update_shared_xref(_xref_dict)
-                        # logger.info(self.shared_xref.copy())
-                else:
-                    sleep(0.07)
-
-                if self._kill is True:
-                    break
-            except Exception as exc:
-                logger.error(f'Error while processing feed: {exc}')
-
-    def _extract_connector_feed(self, entity_feed):
-        if self.mode == 'zerodha':
-            return self._extract_feed_v4(entity_feed)
-        elif self.mode == 'xts':
-            return self._extract_feed_xts(entity_feed)
-        else:
-            logger.error('feed mode not understood')
-            return [], {}
-
-    def _extract_feed_v4(self, entity_feed):
-        keys = entity_feed.keys()
-        # slot, token, last_price, vol, cum_vol, oi
-        feed = [entity_feed['exchange_timestamp'].strftime(self.key_fmt), entity_feed['instrument_token'],
-                entity_feed['last_price'],
-                entity_feed['last_traded_quantity'] if 'last_traded_quantity' in keys else 0,  # For Index
-                entity_feed['volume_traded'] if 'volume_traded' in keys else 0,  # For Index
-                entity_feed['oi'] if 'oi' in keys else 0,  # For Index
-                {'prev_close': entity_feed['ohlc']['close'], 'chg': entity_feed['change'],
-                 'ts': int(entity_feed['exchange_timestamp'].timestamp() * 1000)}
-                ]
-
-        return feed, entity_feed
-
-    def _extract_feed_xts(self, entity_feed):
-        # logger.info(f"extract {entity_feed}")
-        # {'MessageCode': 1502, 'MessageVersion': 4, 'ApplicationType': 0, 'TokenID': 0, 'ExchangeSegment': 2, 'ExchangeInstrumentID': 68094, 'ExchangeTimeStamp': 1396448201, 'Bids': [{'Size': 250, 'Price': 518, 'TotalOrders': 2, 'BuyBackMarketMaker': 0}, {'Size': 450, 'Price': 517.95, 'TotalOrders': 2, 'BuyBackMarketMaker': 0}, {'Size': 100, 'Price': 517.9, 'TotalOrders': 1, 'BuyBackMarketMaker': 0}, {'Size': 50, 'Price': 517.85, 'TotalOrders': 1, 'BuyBackMarketMaker': 0}, {'Size': 500, 'Price': 517.8, 'TotalOrders': 3, 'BuyBackMarketMaker': 0}], 'Asks': [{'Size': 100, 'Price': 519.5, 'TotalOrders': 1, 'BuyBackMarketMaker': 0}, {'Size': 700, 'Price': 519.55, 'TotalOrders': 2, 'BuyBackMarketMaker': 0}, {'Size': 250, 'Price': 519.6, 'TotalOrders': 2, 'BuyBackMarketMaker': 0}, {'Size': 400, 'Price': 519.65, 'TotalOrders': 1, 'BuyBackMarketMaker': 0}, {'Size': 100, 'Price': 519.7, 'TotalOrders': 1, 'BuyBackMarketMaker': 0}], 'Touchline': {'BidInfo': {'Size': 250, 'Price': 518, 'TotalOrders': 2, 'BuyBackMarketMaker': 0}, 'AskInfo': {'Size': 100, 'Price': 519.5, 'TotalOrders': 1, 'BuyBackMarketMaker': 0}, 'LastTradedPrice': 518.75, 'LastTradedQunatity': 50, 'TotalBuyQuantity': 28750, 'TotalSellQuantity': 30300, 'TotalTradedQuantity': 353500, 'AverageTradedPrice': 534.55, 'LastTradedTime': 1396448190, 'LastUpdateTime': 1396448201, 'PercentChange': 8.775424617320194, 'Open': 456.9, 'High': 568.45, 'Low': 456.9, 'Close': 476.9, 'TotalValueTraded': None, 'BuyBackTotalBuy': 0, 'BuyBackTotalSell': 0}, 'BookType': 1, 'XMarketType': 1, 'SequenceNumber': 1341194566648050, 'entity': 'NIFTY24APR22200CE', 'oi': None}
-        touchline = entity_feed.get('Touchline', {})
-        ins_token = self.entity_xref[entity_feed['entity']]
-        feed = [epoch_to_datetime(entity_feed['ExchangeTimeStamp']).strftime(self.key_fmt),
-                ins_token, touchline['LastTradedPrice'],
-                touchline.get('LastTradedQunatity', 0), touchline.get('TotalTradedQuantity', 0),
-                entity_feed.get('oi', 0), {'prev_close': None, 'chg': None, 'ts': None}]
-        xref = {'instrument_token': ins_token, 'last_price': feed[2], 'oi': feed[5]}
-        # logger.info(f"extracted {feed}")
-        return feed, xref
-
-    def _update_shared_xref(self, feed):
-        self.shared_xref[self.token_xref[feed['instrument_token']]] = feed
+            batch, stop = drain_queue(self._recv_queue, self.batch_size, self.batch_ms, timeout=1)
+            now = time()
+            for _ts, _ticks in batch:
+                self.queue_hist.add((now - _ts) * 1000)
+            if batch:
+                try:
+                    ticks = np.concatenate([_ticks for _, _ticks in batch]) if len(batch) > 1 else batch[0][1]
+                    self.batch_hist.add(len(ticks))
+                    # self._ltp_queue.put(ticks)
+                    self.process_ticks(ticks)
+                    # logger.info(self.shared_xref.copy())
+                except Exception as exc:
+                    logger.error(f'Error while processing feed: {exc}')
+
+            if stop:
+                # Shut down in the creator's own process, wherever the feed was stopped from
+                self.flush_candles()
+                self.dump_tick_counts()
+                break
+            if now - last_stats >= self.stats_interval:
+                logger.info(f'Candle Creator {self.name} stats: {self.stats()}')
+                last_stats = now
+
+    def _update_shared_xref(self, ticks: np.ndarray):
+        if self.shared_xref is not None:
+            self.shared_xref.update_many(ticks['slot'], ticks['ltp'], oi=ticks['oi'], volume=ticks['volume'],
+                                         exchange_ts=ticks['ts'])
+
+
+def load_tick_counts(before: str = None) -> dict:
+    """
+    Tick counts of the latest session day dumped before `before` (YYYYMMDD), summed over the dumping creators.
+    :return: entity -> ticks, empty when there is no history
+    """
+    if not os.path.isdir(tick_counts_dir):
+        return {}
+    days = {_file[:8] for _file in os.listdir(tick_counts_dir) if _file.endswith('.csv')}
+    days = sorted(_day for _day in days if before is None or _day < before)
+    if not days:
+        return {}
+    counts = pd.concat([pd.read_csv(os.path.join(tick_counts_dir, _file)) for _file in os.listdir(tick_counts_dir)
+                        if _file.startswith(days[-1]) and _file.endswith('.csv')])
+    logger.info(f'Tick counts of {days[-1]} loaded for {counts["entity"].nunique()} entities')
+    return counts.groupby('entity')['ticks'].sum().to_dict()
 
 
 def init_candle_creator(scrips, tokens, token_xref, feed_receiver, start=True, candle_sender=None,
@@ -210,6 +641,10 @@ def init_candle_creator(scrips, tokens, token_xref, feed_receiver, start=True, c
         cc = CandleCreator(scrips=scrips, tokens=tokens, token_xref=token_xref, receiver=feed_receiver,
                            start=start, c_sender=candle_sender, threaded=threaded, hist_flag=hist_flag, **kwargs)
         logger.info(f'Candle Creator Process running at pid: {psutil.Process().pid}')
-        return cc
+        if not start:
+            return cc
+        # Run the session in this (pool) process until the feed's sentinel, the creator itself does not pickle
+        cc.wait()
+        return cc.stats()
     except Exception as exc:
         logger.error(f'Error while init Candle Creator: {exc}\n{traceback.format_exc()}')
@@ -44,6 +44,7 @@ s_tbl_opt_greeks = Table(
     n_tbl_opt_greeks, metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
     Column('timestamp', TIMESTAMP(True), nullable=False),
+    Column('exchange_ts', TIMESTAMP(True), nullable=True),  # Exchange time watermark of the source snap
     Column('symbol', VARCHAR(50), nullable=False),
     Column('underlying', VARCHAR(50), nullable=False),
     Column('expiry', Date, nullable=False),
@@ -66,6 +67,7 @@ s_tbl_opt_straddle = Table(
     n_tbl_opt_straddle, metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
     Column('timestamp', TIMESTAMP(True), nullable=False),
+    Column('exchange_ts', TIMESTAMP(True), nullable=True),  # Exchange time watermark of the source snap
     Column('underlying', VARCHAR(50), nullable=False),
     Column('expiry', Date, nullable=False),
     Column('strike', Float, nullable=False),
@@ -85,6 +87,28 @@ s_tbl_opt_straddle = Table(
     UniqueConstraint('timestamp', 'underlying', 'expiry', 'strike', name=f'uq_{n_tbl_opt_straddle}_record')
 )
 
+# Latest straddle minima per underlying expiry, replaced on every analysis run (sub-minute with calc_secs)
+n_tbl_opt_straddle_live = 'opt_straddle_live'
+s_tbl_opt_straddle_live = Table(
+    n_tbl_opt_straddle_live, metadata,
+    Column('timestamp', TIMESTAMP(True), nullable=False),
+    Column('exchange_ts', TIMESTAMP(True), nullable=True),
+    Column('underlying', VARCHAR(50), nullable=False),
+    Column('expiry', Date, nullable=False),
+    Column('strike', Float, nullable=False),
+    Column('spot', Float),
+    Column('call_price', Float),
+    Column('put_price', Float),
+    Column('call_oi', Integer),
+    Column('put_oi', Integer),
+    Column('call_iv', Float),
+    Column('put_iv', Float),
+    Column('combined_premium', Float),
+    Column('combined_iv', Float),
+    Column('otm_iv', Float),
+    UniqueConstraint('underlying', 'expiry', name=f'uq_{n_tbl_opt_straddle_live}_record')
+)
+
 n_tbl_chart_users = 'chart_users'
 s_tbl_chart_users = Table(
     n_tbl_chart_users, metadata,
@@ -123,4 +147,12 @@ s_tbl_creds = Table(
 # noinspection PyUnboundLocalVariable
 meta_engine = sql.create_engine(engine_str)
 metadata.create_all(meta_engine)
+# create_all skips existing tables, add columns introduced later. Every importing process runs this, so only ALTER
+# (and take its exclusive lock on a live table) when the column is really missing
+_missing = [_tbl for _tbl in [n_tbl_opt_greeks, n_tbl_opt_straddle]
+            if 'exchange_ts' not in {_col['name'] for _col in sql.inspect(meta_engine).get_columns(_tbl)}]
+if _missing:
+    with meta_engine.begin() as conn:
+        for _tbl in _missing:
+            conn.execute(text(f'ALTER TABLE {_tbl} ADD COLUMN IF NOT EXISTS exchange_ts TIMESTAMP WITH TIME ZONE;'))
 meta_engine.dispose()
@@ -10,7 +10,8 @@ from sqlalchemy import insert, select, text
 # from xts_main import create_token
 from common import logger, today, xts_cred_dict, access_token, data_dir
 from db_config import engine_str, use_sqlite, s_tbl_snap, n_tbl_snap, s_tbl_opt_greeks, n_tbl_opt_greeks, s_tbl_opt_straddle, \
-    n_tbl_opt_straddle, s_tbl_creds, n_tbl_creds, n_tbl_master, s_tbl_master
+    n_tbl_opt_straddle, s_tbl_creds, n_tbl_creds, n_tbl_master, s_tbl_master, s_tbl_opt_straddle_live, \
+    n_tbl_opt_straddle_live
 
 execute_retry = True
 pool = sql.create_engine(engine_str, pool_size=10, max_overflow=5, pool_recycle=67, pool_timeout=30, echo=None)
@@ -179,6 +180,28 @@ class DBHandler:
     def insert_opt_straddle(cls, db_data: list[dict]):
         insert_data(s_tbl_opt_straddle, db_data, ignore=True)
 
+    @classmethod
+    def replace_straddle_live(cls, db_data: list[dict]):
+        # Readers see either the previous run's rows or this run's, never a mix
+        with pool.begin() as conn:
+            conn.execute(s_tbl_opt_straddle_live.delete())
+            if db_data:
+                conn.execute(s_tbl_opt_straddle_live.insert(), db_data)
+
+    @classmethod
+    def get_straddle_live(cls, symbol, expiry):
+        query = f"""
+            SELECT "timestamp" at time zone 'Asia/Kolkata' as ts, spot, strike, combined_premium, combined_iv, otm_iv
+            FROM {n_tbl_opt_straddle_live}
+            WHERE underlying='{symbol}' and date(expiry)='{expiry}'
+            and call_oi > '{threshold_limit}'
+            and put_oi > '{threshold_limit}'
+            and call_iv is not null
+            and put_iv is not null;
+        """
+        df = read_sql_df(query)
+        return df
+
     @classmethod
     def get_straddle_minima(cls, symbol, expiry, start_from=today.replace(hour=9,minute=16,second=0)):
         query = f"""
@@ -5,7 +5,7 @@ import pandas as pd
 
 from analysis import SnapAnalysis
 from common import IST, logger
-from contracts import get_req_contracts
+from contracts import get_universe
 from db_ops import DBHandler
 
 
@@ -40,14 +40,14 @@ def calculate_oi_analytics(start, end):
 
     snap_dt = pd.date_range(start, end, freq='1min').to_pydatetime()
 
-    ins_df, tokens, token_xref = get_req_contracts()
+    universe = get_universe()
     shared_xref = {}
-    # ana = SnapAnalysis(ins_df, tokens, token_xref, shared_xref, enable_scheduler=False)
-    ana = SnapAnalysis(ins_df, tokens, token_xref, shared_xref, use_forward_fut=True, rate=0,
+    # ana = SnapAnalysis(universe, shared_xref, enable_scheduler=False)
+    ana = SnapAnalysis(universe, shared_xref, use_forward_fut=True, rate=0,
                        insert=True, enable_scheduler=False)
-    # ana = SnapAnalysis(ins_df, tokens, token_xref, shared_xref, rate=10, insert=False, enable_scheduler=False)
-    # ana = SnapAnalysis(ins_df, tokens, token_xref, shared_xref, rate=0, use_synthetic=True, insert=False, enable_scheduler=False)
-    # ana = SnapAnalysis(ins_df, tokens, token_xref, shared_xref, rate=0, use_future=True, insert=False, enable_scheduler=False)
+    # ana = SnapAnalysis(universe, shared_xref, rate=10, insert=False, enable_scheduler=False)
+    # ana = SnapAnalysis(universe, shared_xref, rate=0, use_synthetic=True, insert=False, enable_scheduler=False)
+    # ana = SnapAnalysis(universe, shared_xref, rate=0, use_future=True, insert=False, enable_scheduler=False)
     snap_straddle = []
     for dt in snap_dt:
         logger.info(dt)
@@ -1,8 +1,10 @@
 from datetime import datetime
 
+import numpy as np
 from QuantLib import Date, Option, Actual365Fixed, India, Settings, PlainVanillaPayoff, EuropeanExercise, \
     EuropeanOption, QuoteHandle, SimpleQuote, YieldTermStructureHandle, FlatForward, BlackVolTermStructureHandle, \
-    BlackConstantVol, BlackScholesProcess, AnalyticEuropeanEngine
+    BlackConstantVol, BlackScholesProcess, AnalyticEuropeanEngine, NullCalendar
+from scipy.special import ndtr
 
 from common import logger
 
@@ -84,3 +86,275 @@ def get_greeks_intraday(spot_price: float, strike_price: float, expiry_date: dat
         raise TypeError from t_err
 
     return {'iv': iv, 'delta': delta, 'theta': theta, 'gamma': gamma, 'vega': vega, 'rho': rho}
+
+
+def _ql_date(dt: datetime):
+    return Date(dt.day, dt.month, dt.year, dt.hour, dt.minute, dt.second)
+
+
+class QuantLibPricer:
+    """
+    Persistent QuantLib pricing graphs, one per contract per day.
+    Each contract keeps its EuropeanOption, BlackScholesProcess and spot SimpleQuote; rate and vol quotes and their
+    term structures are shared and float with the evaluation date. A run sets the evaluation date once and only
+    pushes new quote values, letting QuantLib's observers recalculate. Results match get_greeks_intraday.
+    """
+
+    def __init__(self, volatility: float = 0.20, risk_free_rate: float = None):
+        self.day_count = Actual365Fixed()
+        self.calendar = NullCalendar()  # Keeps the intraday evaluation time as reference date
+        self.rate_quote = SimpleQuote(10.0 / 100 if risk_free_rate is None else risk_free_rate)
+        self.vol_quote = SimpleQuote(volatility)
+        self.flat_ts = YieldTermStructureHandle(FlatForward(0, self.calendar, QuoteHandle(self.rate_quote),
+                                                            self.day_count))
+        self.flat_vol_ts = BlackVolTermStructureHandle(BlackConstantVol(0, self.calendar, QuoteHandle(self.vol_quote),
+                                                                        self.day_count))
+        self.contracts = {}  # symbol -> (day, expiry, option_type, strike, option, process, spot_quote)
+
+    def _get_contract(self, symbol: str, strike_price: float, expiry_date: datetime, option_type: str, day):
+        contract = self.contracts.get(symbol)
+        if contract is not None and contract[:4] == (day, expiry_date, option_type, strike_price):
+            return contract
+
+        option = Option.Call if option_type in call_types else Option.Put if option_type in put_types else None
+        european_option = EuropeanOption(PlainVanillaPayoff(option, strike_price), EuropeanExercise(_ql_date(expiry_date)))
+        spot_quote = SimpleQuote(0.0)
+        bs_process = BlackScholesProcess(QuoteHandle(spot_quote), self.flat_ts, self.flat_vol_ts)
+        european_option.setPricingEngine(AnalyticEuropeanEngine(bs_process))
+        contract = (day, expiry_date, option_type, strike_price, european_option, bs_process, spot_quote)
+        self.contracts[symbol] = contract
+        return contract
+
+    def get_greeks(self, symbols, spot_prices, strike_prices, expiry_dates, option_types, option_prices,
+                   calculation_date: datetime, risk_free_rate: float = None):
+        """
+        Greeks for a batch of contracts at a single calculation date.
+        :return: dict[str, list]
+                Implied volatility, delta, theta, gamma, vega, rho per contract, None where QuantLib fails
+        """
+        Settings.instance().evaluationDate = _ql_date(calculation_date)
+        self.rate_quote.setValue(10.0 / 100 if risk_free_rate is None else risk_free_rate)
+        day = calculation_date.date()
+
+        result = {'iv': [], 'delta': [], 'theta': [], 'gamma': [], 'vega': [], 'rho': []}
+        for symbol, spot_price, strike_price, expiry_date, option_type, option_price in zip(
+                symbols, spot_prices, strike_prices, expiry_dates, option_types, option_prices):
+            _, _, _, _, european_option, bs_process, spot_quote = self._get_contract(symbol, strike_price, expiry_date,
+                                                                                     option_type, day)
+            try:
+                spot_quote.setValue(spot_price)
+                iv = european_option.impliedVolatility(targetValue=option_price, process=bs_process, minVol=1.0e-4,
+                                                       maxVol=1000, accuracy=1.0e-10, maxEvaluations=100)
+                values = (iv * 100, european_option.delta(), european_option.thetaPerDay(), european_option.gamma(),
+                          european_option.vega(), european_option.rho())
+            except RuntimeError as exc:
+                logger.debug(f'Error in calculating greeks: {exc}')
+                values = (None, None, None, None, None, None)
+            except TypeError as t_err:
+                raise TypeError from t_err
+            for _key, _value in zip(result, values):
+                result[_key].append(_value)
+        return result
+
+    def evict(self, symbols):
+        """Drop graphs of contracts that are no longer part of the universe"""
+        keep = set(symbols)
+        self.contracts = {_s: _c for _s, _c in self.contracts.items() if _s in keep}
+
+
+def _norm_pdf(x):
+    return np.exp(-0.5 * x * x) / np.sqrt(2 * np.pi)
+
+
+def _bs_d1_d2(spot, strike, t, r, q, sigma):
+    sig_t = sigma * np.sqrt(t)
+    d1 = (np.log(spot / strike) + (r - q + 0.5 * sigma * sigma) * t) / sig_t
+    return d1, d1 - sig_t
+
+
+def _bs_price(spot, strike, t, r, q, sigma, is_call):
+    d1, d2 = _bs_d1_d2(spot, strike, t, r, q, sigma)
+    df_q, df_r = np.exp(-q * t), np.exp(-r * t)
+    call = spot * df_q * ndtr(d1) - strike * df_r * ndtr(d2)
+    put = strike * df_r * ndtr(-d2) - spot * df_q * ndtr(-d1)
+    return np.where(is_call, call, put)
+
+
+def _close_to_zero(x, n=42):
+    # QuantLib's close(x, 0.0) as used by its Brent solver at the bracket ends
+    return np.abs(x) < (n * np.finfo(float).eps) ** 2
+
+
+def _normalised_black(x, s, theta):
+    # Undiscounted Black price divided by sqrt(F*K), with x = ln(F/K) and total volatility s = sigma*sqrt(T)
+    d1, d2 = x / s + s / 2, x / s - s / 2
+    return theta * (np.exp(x / 2) * ndtr(theta * d1) - np.exp(-x / 2) * ndtr(theta * d2))
+
+
+def implied_volatility(price, spot, strike, t, r=0.0, q=0.0, option_type='CE', initial=None, iterations: int = 12,
+                       tolerance=1e-8):
+    """
+    Array implied volatility solver for Black-Scholes-Merton prices over a whole option chain at once.
+    In-the-money prices are mapped to their out-of-the-money counterpart and solved in log-price space, starting
+    from a Corrado-Miller rational guess (or `initial`) followed by at most `iterations` Halley steps that fall back
+    to bisection whenever a step leaves the bracket.
+    Never raises: prices below intrinsic, at or above the maximum, and invalid inputs come back as NaN.
+    :param price: array-like
+            Option price
+    :param spot: array-like
+            (S) Spot price
+    :param strike: array-like
+            (K) Strike price
+    :param t: array-like
+            (T) Time to maturity in years
+    :param r: float
+            Risk free rate, continuously compounded
+    :param q: float
+            Dividend yield, continuously compounded
+    :param option_type: array-like
+            Type of option. Possible values: CE, PE (call/put, c/p are accepted too)
+    :param initial: array-like
+            Optional warm start for the volatility, NaN entries fall back to the rational guess
+    :param iterations: int
+            Maximum number of Halley steps
+    :param tolerance: float
+            Largest relative price error accepted as solved, rows beyond it come back as NaN
+    :return: np.ndarray
+            Implied volatility as a decimal, NaN where no volatility reproduces the price
+    """
+    price, spot, strike, t = np.broadcast_arrays(*[np.asarray(_a, dtype=float) for _a in (price, spot, strike, t)])
+    opt = np.broadcast_to(np.char.lower(np.asarray(option_type).astype(str)), price.shape)
+    theta = np.where(np.isin(opt, ['ce', 'ca', 'c', 'call']), 1.0, -1.0)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        valid = np.isfinite(price) & np.isfinite(spot) & np.isfinite(strike) & (t > 0) & (spot > 0) & (strike > 0)
+        t = np.where(valid, t, 1.0)
+        fwd = spot * np.exp((r - q) * t)
+        undiscounted = price * np.exp(r * t)
+        intrinsic = np.maximum(theta * (fwd - strike), 0.0)
+        below_intrinsic = undiscounted < intrinsic
+        above_maximum = undiscounted >= np.where(theta > 0, fwd, strike)
+        valid &= ~below_intrinsic & ~above_maximum
+
+        # Map in-the-money to out-of-the-money
+        x = np.log(fwd / strike)
+        itm = theta * x > 0
+        otm_price = np.where(itm, np.maximum(undiscounted - intrinsic, 0.0), undiscounted)
+        theta = np.where(itm, -theta, theta)
+        beta = otm_price / np.sqrt(fwd * strike)
+        zero = valid & (beta <= 0)
+        active = valid & ~zero
+
+        # Corrado-Miller on the call-equivalent price, floored by the at-the-money Brenner-Subrahmanyam guess
+        call = np.where(theta > 0, otm_price, otm_price + fwd - strike)
+        half = call - (fwd - strike) / 2
+        disc = np.sqrt(np.maximum(half * half - (fwd - strike) ** 2 / np.pi, 0.0))
+        s = np.sqrt(2 * np.pi) / (fwd + strike) * (half + disc)
+        s = np.maximum(np.where(np.isfinite(s), s, 0.0), beta * np.sqrt(2 * np.pi))
+        if initial is not None:
+            warm = np.asarray(initial, dtype=float) * np.sqrt(t)
+            s = np.where(np.isfinite(warm) & (warm > 0), warm, s)
+        s = np.where(active, np.clip(s, 1e-8, 50.0), 1.0)
+
+        lo, hi = np.zeros(price.shape), np.full(price.shape, np.inf)
+        log_beta = np.log(np.where(active, beta, 1.0))
+        for _ in range(iterations):
+            if not active.any():
+                break
+            b = _normalised_black(x, s, theta)
+            lo = np.where(active & (b < beta), s, lo)
+            hi = np.where(active & (b > beta), s, hi)
+            d1, d2 = x / s + s / 2, x / s - s / 2
+            g = np.log(b) - log_beta
+            g1 = np.exp(x / 2) * _norm_pdf(d1) / b
+            g2 = g1 * d1 * d2 / s - g1 * g1
+            step = -g / g1 / (1 - g * g2 / (2 * g1 * g1))
+            done = (g == 0) | (np.abs(step) <= 1e-14 * s)
+            new_s = s + step
+            outside = ~np.isfinite(new_s) | (new_s < lo) | (new_s > hi)
+            new_s = np.where(outside, np.where(np.isfinite(hi), 0.5 * (lo + hi), 2 * s), new_s)
+            s = np.where(active & ~done, new_s, s)
+            active &= ~done
+
+        iv = np.where(zero, 0.0, s / np.sqrt(t))
+        # Rows whose volatility does not reproduce the price ran out of steps (or stalled where the price is flat in
+        # volatility): re-solve a warm start from the rational guess, NaN otherwise
+        residual = np.abs(np.log(_normalised_black(x, s, theta)) - log_beta)
+        active = valid & ~zero & ~(residual <= tolerance)
+        iv = np.where(active, np.nan, iv)
+        if initial is not None and active.any():
+            iv[active] = implied_volatility(price[active], spot[active], strike[active], t[active], r, q,
+                                            opt[active], iterations=iterations, tolerance=tolerance)
+    return np.where(valid, iv, np.nan)
+
+
+def _implied_vol_vectorized(price, spot, strike, t, r, q, is_call, min_vol=1.0e-4, max_vol=1000.0):
+    """
+    implied_volatility under QuantLib's impliedVolatility contract: NaN wherever the price is not bracketed by
+    [min_vol, max_vol], and the bracket end itself when the price already sits on it.
+    """
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        valid = np.isfinite(price) & np.isfinite(spot) & np.isfinite(strike) & (t > 0) & (spot > 0) & (strike > 0)
+        t = np.where(valid, t, 1.0)
+        f_lo = _bs_price(spot, strike, t, r, q, min_vol, is_call) - price
+        f_hi = _bs_price(spot, strike, t, r, q, max_vol, is_call) - price
+        at_lo, at_hi = _close_to_zero(f_lo), _close_to_zero(f_hi)
+        valid &= ((f_lo <= 0) & (f_hi >= 0)) | at_lo | at_hi
+
+    iv = implied_volatility(price, spot, strike, t, r, q, np.where(is_call, 'c', 'p'))
+    iv = np.where(at_lo, min_vol, np.where(at_hi, max_vol, iv))
+    return np.where(valid, iv, np.nan)
+
+
+def get_greeks_vectorized(spot_price, strike_price, time_to_expiry, option_type, option_price, volatility: float = 0.20,
+                          risk_free_rate: float = None):
+    """
+    Array counterpart of get_greeks_intraday for a whole option chain in a few vectorized passes.
+    Implied volatility is solved from the option price; greeks are evaluated at `volatility` exactly as
+    get_greeks_intraday does, so both engines are interchangeable.
+    Matches the QuantLib engine within 1e-6 on iv (in percent) and within 1e-9 on greeks, both absolute.
+    Rows where QuantLib would raise (unbracketed price, expired contract, missing inputs) are NaN across all outputs.
+    :param spot_price: array-like
+            (S) Spot price
+    :param strike_price: array-like
+            (K) Strike price
+    :param time_to_expiry: array-like
+            (T) Time to maturity in years, Actual/365 Fixed
+    :param option_type: array-like
+            Type of option. Possible values: CE, PE
+    :param option_price: array-like
+            Price of the option
+    :param volatility: float
+            Annualised Volatility for underlying.
+    :param risk_free_rate: float
+            Risk free rate to be used by Option Pricing engine.
+    :return: dict[str, np.ndarray]
+            Returns implied volatility, delta, theta, gamma, vega, rho arrays for the option data entered
+    """
+    spot = np.asarray(spot_price, dtype=float)
+    strike = np.asarray(strike_price, dtype=float)
+    t = np.asarray(time_to_expiry, dtype=float)
+    price = np.asarray(option_price, dtype=float)
+    option_type = np.asarray(option_type)
+    is_call = np.isin(option_type, call_types)
+    is_put = np.isin(option_type, put_types)
+    r = 10.0 / 100 if risk_free_rate is None else risk_free_rate
+
+    iv = _implied_vol_vectorized(np.where(is_call | is_put, price, np.nan), spot, strike, t, r, 0.0, is_call)
+    ok = np.isfinite(iv)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(ok, t, 1.0)
+        sqrt_t = np.sqrt(t)
+        d1, d2 = _bs_d1_d2(spot, strike, t, r, 0.0, volatility)
+        pdf_d1 = _norm_pdf(d1)
+        df_r = np.exp(-r * t)
+        delta = np.where(is_call, ndtr(d1), ndtr(d1) - 1)
+        gamma = pdf_d1 / (spot * volatility * sqrt_t)
+        vega = spot * pdf_d1 * sqrt_t
+        theta = -spot * pdf_d1 * volatility / (2 * sqrt_t) + np.where(is_call, -r * strike * df_r * ndtr(d2),
+                                                                      r * strike * df_r * ndtr(-d2))
+        rho = np.where(is_call, strike * t * df_r * ndtr(d2), -strike * t * df_r * ndtr(-d2))
+
+    result = {'iv': iv * 100, 'delta': delta, 'theta': theta / 365, 'gamma': gamma, 'vega': vega, 'rho': rho}
+    return {_k: np.where(ok, _v, np.nan) for _k, _v in result.items()}
@@ -1,16 +1,27 @@
 import os
 from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import get_context, Manager, Pipe
-from time import sleep
 from datetime import datetime
+import numpy as np
 import xts_main
 from analysis import start_analysis
+from atm_window import AtmWindow
+from data_handler import candle_dtype, minute_keys
 from common import logger
-from contracts import get_req_contracts
+from contracts import get_universe
+from quote_table import QuoteTable
+from xts_gateway import gateway_wrapper
 from zerodha import initiate_session, zws_wrapper
 
 
-def main():
+def main(use_gateway=False, atm_window=0, journal=False, calc_secs=60):
+    """
+    :param use_gateway: Run every XTS session on one asyncio gateway process instead of a process tree per session
+    :param atm_window: Keep only this many strikes each side of the ATM subscribed (XTS), 0 subscribes every strike
+    :param journal: Record every tick to the day's tick journal, see data_handler.TickJournal and replay.py
+    :param calc_secs: Analysis cadence in secs, of opt_straddle_live and /straddle/live. opt_greeks/opt_straddle and
+        snap are still persisted every minute
+    """
     choice = str(input("Enter broker(zerodha/XTS): ")).lower()
 
     workers = max(os.cpu_count(), 6)
@@ -23,44 +34,68 @@ def main():
         else:
             client = initiate_session()     # connection to zerodha kite
 
-        ins_df, tokens, token_xref = get_req_contracts()
+        universe = get_universe()  # Loaded once, passed on to every consumer
+        ins_df, tokens, token_xref = universe
         logger.info(f'Entities for broadcast: {len(tokens)}')
 
-        mp = Manager()
         # hist_flag = mp.Event()  # Moved to per instance
         # hist_flag.set()
 
-        # common dictionary
-        latest_feed_xref = mp.dict({_entity: {} for _token, _entity in token_xref.items()})  # Shared Among different
+        # common quote table, in shared memory
+        # One writer lane per broadcast session, plus one for the ATM window clearing unsubscribed strikes
+        lanes = len(access_tokens) + (1 if atm_window else 0) if choice == 'xts' else 1
+        latest_feed_xref = QuoteTable(token_xref, lanes=lanes)  # Shared Among different
 
         # Initialize Pipe Objects
         candle_receiver, candle_send = Pipe(duplex=False)
+        mp = Manager()
+        candle_lock = mp.Lock()  # One minute batch at a time on the shared candle pipe
 
         # Initiate Candle Data Processor
         # noinspection PyTypeChecker
-        data_processor = executor.submit(start_analysis, ins_df, tokens, token_xref, shared_xref=latest_feed_xref)  # NOSONAR
+        data_processor = executor.submit(start_analysis, universe, shared_xref=latest_feed_xref, calc_secs=calc_secs)  # NOSONAR
 
         # Initialize Broadcast
         if choice == "xts":
 
             # divide entities into tokens
             ins_df_list = xts_main.split_into_tokens(access_tokens, ins_df)     # ins_df_list[i] is a Dataframe
-            xts_main.subscribe_init(tokens=access_tokens, headers=headers, ch=ch, df=ins_df_list)  # subscribe
+            if ch == 'subs' and atm_window:
+                window = AtmWindow(ins_df_list, access_tokens, headers, latest_feed_xref.writer(len(access_tokens)),
+                                   window=atm_window)
+                xts_main.subscribe_init(tokens=access_tokens, headers=headers, ch=ch, df=window.initial())
+                window.start()
+            else:
+                xts_main.subscribe_init(tokens=access_tokens, headers=headers, ch=ch, df=ins_df_list)  # subscribe
 
             xts_token_xref = ins_df.set_index('exchange_token')['tradingsymbol'].to_dict()
-            if ch == 'subs':
+            if ch == 'subs' and use_gateway:
+                # noinspection PyTypeChecker
+                executor.submit(gateway_wrapper, tokens, token_xref, access_tokens, userids, candle_send,
+                                latest_feed_xref=latest_feed_xref.writer(0), xts_token_xref=xts_token_xref,
+                                candle_lock=candle_lock, journal=journal)
+            elif ch == 'subs':
                 for i in range(len(access_tokens)):
                     # push data for each token
                     executor.submit(xts_main.xts_wrapper, tokens, token_xref, [], access_tokens[i], userids[i], candle_send,
-                                    latest_feed_xref=latest_feed_xref, xts_token_xref=xts_token_xref)
+                                    name=str(i + 1), latest_feed_xref=latest_feed_xref.writer(i),
+                                    xts_token_xref=xts_token_xref, candle_lock=candle_lock, journal=journal)
 
         else:
             # noinspection PyTypeChecker
             executor.submit(zws_wrapper, tokens, token_xref, [], client, candle_send,
-                            name=1, latest_feed_xref=latest_feed_xref)
-
-        while True:
-            sleep(30)
+                            name=1, latest_feed_xref=latest_feed_xref.writer(0), candle_lock=candle_lock,
+                            journal=journal)
+
+        try:
+            while True:
+                # Drain minute bars so the candle creators never block on a full pipe
+                if candle_receiver.poll(30):
+                    bars = np.frombuffer(candle_receiver.recv_bytes(), dtype=candle_dtype)
+                    if len(bars):
+                        logger.debug(f'Candles for {minute_keys[bars["minute"][0]]}: {len(bars)}')
+        finally:
+            latest_feed_xref.close()
 
 
 if __name__ == '__main__':
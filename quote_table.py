@@ -0,0 +1,157 @@
+from copy import copy
+from datetime import datetime
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from common import logger, IST
+
+
+class QuoteTable:
+    """
+    Live quote table in shared memory, one slot per token of token_xref. Every field is a flat NumPy array laid out
+    back to back in a single segment, so writers update a slot in place and readers snapshot the whole table with
+    one buffer copy. Pickles by segment name, so it can be handed to spawned processes like the Manager dict it
+    replaces; only the creating process unlinks the segment.
+    Reads are made consistent with a seqlock per writer lane: a writer bumps its lane's sequence to odd before
+    touching a slot and back to even after, and a reader retries its copy until every lane was even and unchanged
+    across it. Writers never wait on readers. Each writer process must own its lane, see writer().
+    """
+    fields = [('last_price', 'f8'), ('oi', 'f8'), ('volume', 'f8'), ('exchange_ts', 'i8')]  # exchange_ts in epoch ms
+
+    def __init__(self, token_xref: dict, name=None, lanes=1, lane=0):
+        self.token_xref = token_xref  # token -> entity
+        self.lanes = lanes
+        self.lane = lane
+        self.tokens = list(token_xref.keys())
+        self.entities = [token_xref[_token] for _token in self.tokens]
+        self.token_slot = self.slots(token_xref)
+        self.entity_slot = {_entity: _slot for _slot, _entity in enumerate(self.entities)}
+        self.size = len(self.tokens)
+        self.owner = name is None
+        if self.owner:
+            self.shm = SharedMemory(create=True, size=max(self.nbytes, 1))
+        else:
+            self.shm = SharedMemory(name=name)
+        self._raw = np.ndarray(self.nbytes, dtype=np.uint8, buffer=self.shm.buf)
+        for _field, _view in self._views(self._raw).items():
+            setattr(self, _field, _view)
+        if self.owner:
+            self.clear()
+            logger.info(f'Quote table created: {self.size} slots, {self.nbytes} bytes in {self.shm.name}')
+
+    @property
+    def nbytes(self):
+        return sum(np.dtype(_dtype).itemsize * self.size for _, _dtype in self.fields) + 8 * self.lanes
+
+    def _views(self, raw: np.ndarray) -> dict:
+        views, offset = {}, 0
+        for _field, _dtype in self.fields:
+            _dtype = np.dtype(_dtype)
+            views[_field] = raw[offset:offset + _dtype.itemsize * self.size].view(_dtype)
+            offset += _dtype.itemsize * self.size
+        views['seq'] = raw[offset:offset + 8 * self.lanes].view(np.int64)
+        return views
+
+    @staticmethod
+    def slots(token_xref: dict) -> dict:
+        """Stable token -> slot map, the order of token_xref"""
+        return {_token: _slot for _slot, _token in enumerate(token_xref)}
+
+    def __getstate__(self):
+        return {'token_xref': self.token_xref, 'name': self.shm.name, 'lanes': self.lanes, 'lane': self.lane}
+
+    def __setstate__(self, state):
+        self.__init__(state['token_xref'], name=state['name'], lanes=state['lanes'], lane=state['lane'])
+
+    def writer(self, lane):
+        """Handle on the same segment bound to a writer lane, to be passed to the process that owns the lane"""
+        if not 0 <= lane < self.lanes:
+            raise ValueError(f'Writer lane {lane} out of range, table has {self.lanes} lanes')
+        handle = copy(self)
+        handle.owner = False
+        handle.lane = lane
+        return handle
+
+    def clear(self, slots=None):
+        slots = slice(None) if slots is None else slots
+        self.seq[self.lane] += 1
+        self.last_price[slots] = np.nan
+        self.oi[slots] = np.nan
+        self.volume[slots] = np.nan
+        self.exchange_ts[slots] = 0
+        self.seq[self.lane] += 1
+
+    def update(self, token, last_price, oi=None, volume=None, exchange_ts=None):
+        slot = self.token_slot.get(token, None)
+        if slot is None:
+            return
+        seq = self.seq
+        seq[self.lane] += 1
+        self.last_price[slot] = np.nan if last_price is None else last_price
+        self.oi[slot] = np.nan if oi is None else oi
+        self.volume[slot] = np.nan if volume is None else volume
+        self.exchange_ts[slot] = 0 if exchange_ts is None else exchange_ts
+        seq[self.lane] += 1
+
+    def update_many(self, slots, last_price, oi, volume, exchange_ts):
+        """Write a batch of ticks by slot in one seqlock window, the last tick of a repeated slot wins"""
+        seq = self.seq
+        seq[self.lane] += 1
+        self.last_price[slots] = last_price
+        self.oi[slots] = oi
+        self.volume[slots] = volume
+        self.exchange_ts[slots] = exchange_ts
+        seq[self.lane] += 1
+
+    def snapshot(self, retries=1000) -> dict:
+        """
+        Point-in-time copy of every field, taken with a single copy of the shared buffer once no writer was mid-update
+        across it. Falls back to the last copy (and logs) if writers keep it busy for `retries` attempts.
+        """
+        for _ in range(retries):
+            seq = self.seq.copy()
+            if (seq & 1).any():
+                continue
+            raw = self._raw.copy()
+            if np.array_equal(seq, self.seq):
+                return self._views(raw)
+        logger.warning(f'Quote table snapshot not consistent after {retries} attempts')
+        return self._views(self._raw.copy())
+
+    @staticmethod
+    def watermark(snap: dict):
+        """Latest exchange time reflected in the snapshot, None before the first tick"""
+        last_ts = int(snap['exchange_ts'].max(initial=0))
+        return datetime.fromtimestamp(last_ts / 1000, tz=IST) if last_ts > 0 else None
+
+    def to_xref(self, snap: dict) -> dict:
+        """
+        Snapshot in the entity -> {last_price, oi, ...} shape of the former shared dict. Entities without a tick
+        yet map to an empty dict, missing values are None.
+        """
+        ticked = snap['exchange_ts'] != 0
+        ticked |= ~np.isnan(snap['last_price'])
+        xref = {_entity: {} for _entity in self.entities}
+        columns = {_field: snap[_field].astype(object) for _field, _ in self.fields}
+        for _field in ('last_price', 'oi', 'volume'):
+            columns[_field][np.isnan(snap[_field])] = None
+        for _slot in np.flatnonzero(ticked):
+            xref[self.entities[_slot]] = {'instrument_token': self.tokens[_slot],
+                                          **{_field: columns[_field][_slot] for _field, _ in self.fields}}
+        return xref
+
+    def copy(self) -> dict:
+        """Drop-in for dict.copy() on the former Manager dict"""
+        return self.to_xref(self.snapshot())
+
+    def snapshot_xref(self):
+        """Consistent snapshot as the entity dict along with its exchange-time watermark"""
+        snap = self.snapshot()
+        return self.to_xref(snap), self.watermark(snap)
+
+    def close(self):
+        self.last_price = self.oi = self.volume = self.exchange_ts = self.seq = self._raw = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
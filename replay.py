@@ -0,0 +1,60 @@
+import sys
+from multiprocessing import Pipe
+from time import sleep, time
+
+import numpy as np
+
+from common import logger
+from data_handler import DataHandler, CandleCreator, read_journal, tick_dtype
+
+
+def replay(path, token_xref: dict = None, speed=1.0, **kwargs):
+    """
+    Push a tick journal through DataHandler -> Pipe -> CandleCreator the way the live feed does, in batches of the
+    recorded receive times, paced `speed` times faster than recorded. speed 0 replays as fast as possible.
+    :param path: journal file, see data_handler.TickJournal
+    :param token_xref: token -> entity to replay against, every token of the journal if None. Others are skipped
+    :param kwargs: batch_ms, conflate_ms for the DataHandler, anything else (shared_xref, c_sender, ...) for the
+        CandleCreator
+    :return: CandleCreator, stopped, with the session's bars in .candles
+    """
+    records = read_journal(path)
+    if token_xref is None:
+        token_xref = {int(_token): str(_token) for _token in np.unique(records['token'])}
+    batch_ms = kwargs.pop('batch_ms', 5)
+    feed_receiver, feed_send = Pipe(duplex=False)
+    handler = DataHandler(sender=feed_send, token_xref=token_xref, conflate_ms=kwargs.pop('conflate_ms', 0))
+    cc = CandleCreator([], list(token_xref), token_xref, feed_receiver, start=True, name='replay', **kwargs)
+
+    # token -> slot for every record, -1 for tokens outside token_xref
+    tokens, inverse = np.unique(records['token'], return_inverse=True)
+    slots = np.array([handler.token_slot.get(int(_token), -1) for _token in tokens], dtype=np.int64)[inverse]
+
+    # Live batches: ticks received within the same batch_ms window
+    recv_ts = records['recv_ts']
+    t0 = recv_ts[0] if len(records) else 0
+    window = ((recv_ts - t0) * 1000 // batch_ms).astype(np.int64)
+    bounds = np.append(np.flatnonzero(np.diff(window, prepend=-1)), len(records))
+
+    st = time()
+    for _lo, _hi in zip(bounds[:-1], bounds[1:]):
+        if speed:
+            wait = st + (recv_ts[_lo] - t0) / speed - time()
+            if wait > 0:
+                sleep(wait)
+        known = slots[_lo:_hi] >= 0
+        ticks = np.empty(int(known.sum()), dtype=tick_dtype)
+        ticks['slot'] = slots[_lo:_hi][known]
+        for _field in ('ts', 'ltp', 'ltq', 'volume', 'oi'):
+            ticks[_field] = records[_field][_lo:_hi][known]
+        handler.push_ticks(ticks.tolist(), time())
+    handler.push_ticks([], time(), flush=True)
+    feed_send.send_bytes(b'')
+    cc.stop_processor()
+    logger.info(f'Replayed {len(records)} ticks of {path} in {time() - st:.2f} secs')
+    return cc
+
+
+if __name__ == '__main__':
+    # python replay.py <journal> [speed]
+    replay(sys.argv[1], speed=float(sys.argv[2]) if len(sys.argv) > 2 else 0)
@@ -0,0 +1,91 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from common import holidays, b_days, today
+
+weekmask = '1111100'
+session_hours = 6.25  # 09:15 - 15:30
+
+
+class TradingCalendar:
+    """
+    Business-day index built once per process. Holds the cumulative count of business days from `origin`, so the
+    number of business days between any two dates is two array lookups.
+    DTE follows analysis.get_dte: business days from today to expiry (both inclusive, Mon-Fri minus holidays) less
+    one, plus the fraction of today's 6.25 hour session still left.
+    Special sessions (e.g. Saturday drills) are tracked separately and are not counted towards DTE unless
+    `count_special_sessions` is set.
+    """
+
+    def __init__(self, holidays_arr: list, special_sessions: list = None, start=None, end=None,
+                 count_special_sessions=False):
+        self.holidays = np.array(holidays_arr, dtype='datetime64[D]')
+        self.special_sessions = np.array([] if special_sessions is None else special_sessions, dtype='datetime64[D]')
+        self.count_special_sessions = count_special_sessions
+        start = np.datetime64(today.date() if start is None else start, 'D') - np.timedelta64(366, 'D')
+        end = np.datetime64(today.date() if end is None else end, 'D') + np.timedelta64(3 * 366, 'D')
+        self.origin = None
+        self.is_bday = None
+        self.cum_bdays = None
+        self._build(start, end)
+
+    @classmethod
+    def from_common(cls, **kwargs):
+        special = [_day for _day in b_days if _day.dayofweek >= 5 or _day.strftime('%Y-%m-%d') in holidays]
+        return cls(holidays, special_sessions=special, **kwargs)
+
+    def _build(self, start, end):
+        days = np.arange(start, end + np.timedelta64(1, 'D'), dtype='datetime64[D]')
+        is_bday = np.is_busday(days, weekmask=weekmask, holidays=self.holidays)
+        if self.count_special_sessions:
+            is_bday |= np.isin(days, self.special_sessions)
+        self.origin = start
+        self.is_bday = is_bday
+        self.cum_bdays = np.cumsum(is_bday)
+
+    def _ensure(self, dates: np.ndarray):
+        if dates.size == 0:
+            return
+        lo, hi = dates.min(), dates.max()
+        end = self.origin + np.timedelta64(len(self.is_bday) - 1, 'D')
+        if lo < self.origin or hi > end:
+            self._build(min(lo, self.origin), max(hi, end) + np.timedelta64(366, 'D'))
+
+    def network_days(self, start, end):
+        """Business days in [start, end], both inclusive. Accepts scalars or arrays of dates."""
+        start = np.asarray(start, dtype='datetime64[D]')
+        end = np.asarray(end, dtype='datetime64[D]')
+        self._ensure(np.concatenate([start.ravel(), end.ravel()]))
+        s_idx = (start - self.origin).astype(np.int64)
+        e_idx = (end - self.origin).astype(np.int64)
+        count = self.cum_bdays[e_idx] - self.cum_bdays[s_idx] + self.is_bday[s_idx]
+        return np.where(e_idx >= s_idx, count, 0)
+
+    def is_session(self, day) -> bool:
+        day = np.datetime64(day, 'D')
+        return bool(np.is_busday(day, weekmask=weekmask, holidays=self.holidays) or day in self.special_sessions)
+
+    def dte(self, dt: datetime, expiry):
+        """
+        DTE for every expiry at evaluation time `dt` (tz-naive, IST wall clock).
+        :param dt: datetime
+        :param expiry: datetime or array-like of datetimes
+        :return: float or np.ndarray, matching the shape of expiry
+        """
+        dt = pd.Timestamp(dt)
+        close = dt.normalize() + pd.Timedelta(hours=15, minutes=30)
+        # Same arithmetic (and float rounding) as calc_dte on the first leg of the date range
+        frac = max(((close - dt).total_seconds() / 3600) / 24 / session_hours * 24, 0)
+
+        if np.ndim(expiry) and len(expiry) == 0:
+            return np.array([], dtype=float)
+        expiry_days = np.asarray(pd.DatetimeIndex(np.atleast_1d(expiry)).normalize().values, dtype='datetime64[D]')
+        today_day = np.datetime64(dt.date(), 'D')
+        n_days = self.network_days(np.full(expiry_days.shape, today_day), expiry_days)
+        dte = np.where(expiry_days < today_day, frac, np.maximum(n_days - 1 + frac, n_days - 1))
+        return dte if np.ndim(expiry) else float(dte[0])
+
+
+trading_calendar = TradingCalendar.from_common()
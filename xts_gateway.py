@@ -0,0 +1,135 @@
+import asyncio
+import json
+from datetime import datetime
+from time import time
+
+import numpy as np
+import socketio
+
+from common import logger, socket_url
+from data_handler import DataHandler, CandleCreator, Histogram, latency_edges, tick_dtype
+from xts_main import XtsWS, decode_md, decode_oi, json_loads
+
+
+class XtsGateway:
+    """
+    Every XTS market data session as a coroutine on one event loop, in one process. Ticks are decoded in the socket
+    handlers and applied straight to the shared quote table and the minute candles every `flush_ms`, instead of
+    travelling socket -> DataHandler -> Pipe -> CandleCreator per session.
+    """
+    close_time = XtsWS.close_time
+
+    def __init__(self, tokens, token_xref, access_tokens: list, user_ids: list, candle_send=None, **kwargs):
+        self.tokens = tokens
+        self.token_xref = token_xref
+        self.access_tokens = access_tokens
+        self.user_ids = user_ids
+        self.xts_token_xref = kwargs.get('xts_token_xref', {})
+        self.selective_decode = kwargs.get('selective_decode', json_loads is json.loads)
+        self.flush_ms = kwargs.get('flush_ms', 5)
+        self.stats_interval = kwargs.get('stats_interval', 60)  # secs
+
+        # Extraction (and optional conflation) of DataHandler, state updates of CandleCreator, without their threads
+        self.handler = DataHandler(token_xref=token_xref, mode='xts', conflate_ms=kwargs.get('conflate_ms', 0),
+                                   name='gateway', journal=kwargs.get('journal', False))
+        self.candles = CandleCreator([], tokens, token_xref, None, start=False, c_sender=candle_send,
+                                     candle_lock=kwargs.get('candle_lock', None), name='gateway',
+                                     shared_xref=kwargs.get('latest_feed_xref', None))
+        self.latency_hist = Histogram(latency_edges)  # socket handler -> applied, ms
+        self.entity_oi_xref = {}
+        self.clients = []
+        self._pending = []  # (received at, decoded 1502 payload)
+
+    def _new_client(self, name):
+        client = socketio.AsyncClient(request_timeout=120, logger=False, engineio_logger=False, ssl_verify=False)
+
+        async def on_connect():
+            logger.info(f'{name} Connected to Socket')
+
+        async def on_disconnect():
+            logger.info(f'{name} Disconnected from Socket')
+
+        async def on_error(data):
+            logger.info(f'{name} Error from Socket: {data}')
+
+        client.on('connect', on_connect)
+        client.on('disconnect', on_disconnect)
+        client.on('error', on_error)
+        client.on('1502-json-full', self.on_message_md)
+        client.on('1510-json-full', self.on_message_io)
+        return client
+
+    async def on_message_md(self, raw_data):
+        data: dict = decode_md(raw_data, self.selective_decode)
+        entity_name = self.xts_token_xref.get(data['ExchangeInstrumentID'], None)  # get entity name via exchange id
+        if entity_name:
+            data.update({'entity': entity_name, 'oi': self.entity_oi_xref.get(entity_name, None)})
+            self._pending.append((time(), data))
+
+    async def on_message_io(self, raw_data):
+        data = decode_oi(raw_data, self.selective_decode)
+        entity_name = self.xts_token_xref.get(data['ExchangeInstrumentID'], None)  # take entity name via exchange id
+        if entity_name:
+            self.entity_oi_xref[entity_name] = data['OpenInterest']
+
+    def flush(self, final=False):
+        pending, self._pending = self._pending, []
+        now = time()
+        for _ts, _ in pending:
+            self.latency_hist.add((now - _ts) * 1000)
+        ticks = self.handler.extract_ticks([(now, [_data for _, _data in pending])])
+        if self.handler.conflate_ms:
+            if self.handler.journal is not None and ticks:
+                self.handler.journal.append(np.array(ticks, dtype=tick_dtype), now)
+            ticks = self.handler.conflate(ticks, now, flush=final)
+        if ticks:
+            ticks = np.array(ticks, dtype=tick_dtype)
+            if self.handler.journal is not None and not self.handler.conflate_ms:
+                self.handler.journal.append(ticks, now)
+            self.candles.process_ticks(ticks)
+
+    async def _flusher(self):
+        last_stats = time()
+        while True:
+            await asyncio.sleep(self.flush_ms / 1000)
+            try:
+                self.flush()
+            except Exception as exc:
+                logger.error(f'Error while processing feed: {exc}')
+            if time() - last_stats >= self.stats_interval:
+                logger.info(f'XTS Gateway stats: {self.stats()}')
+                last_stats = time()
+
+    def stats(self):
+        return {'sessions': len(self.clients), 'latency_ms': self.latency_hist.summary(),
+                'conflated': self.handler.conflated, **self.candles.stats()}
+
+    async def run(self):
+        flusher = asyncio.create_task(self._flusher())
+        for _i, (_token, _user_id) in enumerate(zip(self.access_tokens, self.user_ids)):
+            client = self._new_client(f'soc_{_i}')
+            ws_url = f"{socket_url}/apimarketdata/socket.io/?token={_token}&userID={_user_id}&broadcastMode=Full&publishFormat=JSON"
+            await client.connect(ws_url, transports='websocket', socketio_path='apimarketdata/socket.io')
+            self.clients.append(client)
+        logger.info(f'XTS Gateway running {len(self.clients)} sessions')
+
+        while datetime.now() < self.close_time:
+            await asyncio.sleep(1)
+        logger.info('XTS Gateway Market Closed. Wrapping Up....')
+        for _client in self.clients:
+            await _client.disconnect()
+        flusher.cancel()
+        self.flush(final=True)
+        self.candles.flush_candles()
+        self.candles.dump_tick_counts()
+        if self.handler.journal is not None:
+            self.handler.journal.close()
+        logger.info(f'XTS Gateway Exits. Stats: {self.stats()}')
+
+
+def gateway_wrapper(*args, **kwargs):
+    try:
+        asyncio.run(XtsGateway(*args, **kwargs).run())
+    except Exception as ec:
+        logger.error(f'Error in XTS Gateway: {ec}')
+    logger.error("XTS gateway exits")
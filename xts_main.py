@@ -1,19 +1,41 @@
+import heapq
 import json
 import multiprocessing as mp
-from concurrent.futures import ProcessPoolExecutor
-from time import sleep
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime
+from time import sleep, perf_counter
 from tqdm import tqdm
 import numpy as np
+import pandas as pd
 import requests
 import socketio
+from requests.adapters import HTTPAdapter
 from dateutil.relativedelta import relativedelta
 
-from common import today, logger, xts_cred_dict, create_token, host, socket_url, subscription_url
-from data_handler import DataHandler, init_candle_creator
+from common import today, logger, xts_cred_dict, create_token, host, socket_url, subscription_url, data_dir
+from data_handler import DataHandler, init_candle_creator, load_tick_counts
 from db_ops import DBHandler
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # from multiprocessing import Manager
 
+subscription_chunk = 50  # instruments per (un)subscription request
+already_subscribed = 'e-session-0002'
+report_columns = ['token', 'xts_message_code', 'exchange_segment', 'exchange_instrument_id', 'status_code', 'code',
+                  'description', 'success']
+_http_local = threading.local()
+# (Un)subscription requests of every call share these threads, so their keep-alive sessions outlive a call
+_http_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='XTS HTTP')
+session_secs = 6.25 * 3600  # 09:15 to 15:30
+moneyness_width = 0.02  # strikes ~2% off the centre tick at 1/e the rate of the centre
+
 
 # host = "https://algozy.rathi.com:3000"
 # socket_url = "wss://algozy.rathi.com:3000"
@@ -46,59 +68,135 @@ def test_token(token):
     return response.status_code
 
 
-def split_into_tokens(tokens: list, df):
-
+def split_into_tokens(tokens: list, df, **kwargs):
+    """
+    Shard the instruments across the tokens (accounts) by expected message rate. Instruments are taken hottest first
+    and each goes to the least loaded account (greedy bin-packing), so every socket carries about the same load.
+    Rates come from the previous session's tick counts, instruments without history fall back to expected_rates().
+    :param tokens: access tokens
+    :param df: instruments, one row each
+    :param kwargs: tick_counts (entity -> ticks) to override the dumped history
+    :return: list of DataFrames, one per token in order
+    """
     n = len(tokens)
+    tick_counts = kwargs.get('tick_counts', None)
+    if tick_counts is None:
+        tick_counts = load_tick_counts(before=today.strftime('%Y%m%d'))
+    rates = shard_rates(df, tick_counts)
+
+    loads = [(0.0, 0, _i) for _i in range(n)]  # (rate, instruments, account) heap
+    account = np.empty(len(df), dtype=np.int64)
+    for _row in np.argsort(-rates, kind='stable'):
+        _rate, _count, _i = heapq.heappop(loads)
+        account[_row] = _i
+        heapq.heappush(loads, (_rate + rates[_row], _count + 1, _i))
+
+    temp = [df[account == _i] for _i in range(n)]
+    for _i in range(n):
+        logger.info(f'Token {_i + 1}: {len(temp[_i])} instruments, expected {rates[account == _i].sum():.2f} ticks/sec')
+    return temp
 
-    # splitting to n equal parts
-    temp = np.array_split(df, n)
 
-    return temp
+def shard_rates(df, tick_counts: dict) -> np.ndarray:
+    """
+    Expected ticks per second of every instrument: the previous session's rate where there is one, else the
+    heuristic rate scaled to the history of the instruments that have both.
+    """
+    rates = expected_rates(df)
+    if not tick_counts:
+        logger.info(f'No tick history, sharding {len(df)} instruments on the moneyness/expiry heuristic')
+        return rates
+    history = df['tradingsymbol'].map(tick_counts).to_numpy(dtype=float) / session_secs
+    known = ~np.isnan(history)
+    if known.any() and rates[known].sum() > 0:
+        rates = rates * history[known].sum() / rates[known].sum()
+    logger.info(f'Sharding on tick history of {known.sum()}/{len(df)} instruments')
+    return np.where(known, history, rates)
+
+
+def expected_rates(df) -> np.ndarray:
+    """
+    Relative message rate of instruments without history. Options decay with distance from the strike centre of
+    their (name, expiry), a proxy for ATM before the first tick, and with the expiry's rank; futures and underlyings
+    tick like the ATM of the near expiry.
+    """
+    rates = np.ones(len(df))
+    is_opt = df['instrument_type'].isin(['CE', 'PE']).to_numpy()
+    if not is_opt.any():
+        return rates
+    opt = df[is_opt]
+    centre = opt.groupby(['name', 'expiry'])['strike'].transform('median').to_numpy(dtype=float)
+    moneyness = np.abs(opt['strike'].to_numpy(dtype=float) / centre - 1)
+    expiry_rank = opt.groupby('name')['expiry'].rank(method='dense').to_numpy() - 1
+    rates[is_opt] = np.exp(-moneyness / moneyness_width) / (1 + expiry_rank)
+    return rates
 
 
 # payload + subscribe + status
-def subscribe_init(tokens, headers, ch, df):
-    # create payload - for each token
-    subscription_payload = {}
-    subscription_payload_oi = {}
+def subscribe_init(tokens, headers, ch, df, **kwargs):
+    """
+    (Un)subscribe every token's instruments for market data (1502) and open interest (1510). Payloads are split into
+    chunks of at most `chunk_size` instruments and all chunks of all tokens are sent concurrently on the module's
+    request threads, over their keep-alive sessions.
+    :param tokens: access tokens
+    :param headers: token -> request headers
+    :param ch: 'subs' or 'unsubs'
+    :param df: list of instrument DataFrames, df[i] for tokens[i]
+    :return: pd.DataFrame, one row per (token, message code, instrument) with the broker's status
+    """
+    chunk_size = kwargs.get('chunk_size', subscription_chunk)
+    request = subs if ch == 'subs' else unsubs
+
+    # create payload chunks - for each token, market data and open interest
+    jobs = []
     for i in range(len(tokens)):
         inst_id, exch_seg = list(df[i]['exchange_token']), list(df[i]['exchange'])
-        subscription_payload[tokens[i]] = create_payload(inst_id, exch_seg)  # market data
-        subscription_payload_oi[tokens[i]] = create_payload_oi(inst_id, exch_seg)  # open interest
-
-    status_list = []
-
-    if ch == 'subs':
-        # subscribe symbols - for each token
-        for token in tokens:
-            status_code, status = subs(subscription_payload[token], headers[token])     # market data
-            status_list.append([status_code, status])
-            status_code, status = subs(subscription_payload_oi[token], headers[token])  # open interest
-            status_list.append([status_code, status])
-
-    elif ch == 'unsubs':
-        # unsubscribe symbols - for each token
-        for token in tokens:
-            status_code, status = unsubs(subscription_payload[token], headers[token])   # market data
-            status_list.append([status_code, status])
-            status_code, status = unsubs(subscription_payload_oi[token], headers[token])    # open interest
-            status_list.append([status_code, status])
-
-    # check if all token subscription status are 200
-    flag = 0
-    for i in range(len(status_list)):
-        if status_list[i][0] != 200:
-            status_list[i][1] = json.loads(status_list[i][1])
-            if status_list[i][1]["code"] == "e-session-0002":     # already subscribed
-                logger.warn(f'{status_list[i][1]["description"]}, {status_list[i][1]["result"]}')
-            else:
-                logger.warn(f"Token {i+1} error message: ", status_list[i][1])  # unknown error handling
-                flag += 1
-
-    if flag > 0:
-        return "Unsuccessful"       # response status not 200 due to unknown error
-    else:
-        return "Successful"
+        for _payload in (create_payload(inst_id, exch_seg), create_payload_oi(inst_id, exch_seg)):
+            for _chunk in chunk_payload(_payload, chunk_size):
+                jobs.append((i, _chunk))
+
+    rows = []
+    futures = {_http_pool.submit(request, _chunk, headers[tokens[_i]]): (_i, _chunk) for _i, _chunk in jobs}
+    for _future in as_completed(futures):
+        _i, _chunk = futures[_future]
+        try:
+            status_code, status = _future.result()
+        except requests.RequestException as exc:
+            status_code, status = None, str(exc)
+        rows.extend(subscription_status(_i, _chunk, status_code, status))
+
+    report = pd.DataFrame(rows, columns=report_columns)
+    failed = report[~report['success'].astype(bool)]
+    logger.info(f'{ch}: {report["success"].sum()}/{len(report)} instrument requests successful across '
+                f'{len(tokens)} tokens in {len(jobs)} requests')
+    for (_i, _code, _description), _df in failed.groupby(['token', 'code', 'description'], dropna=False):
+        logger.warning(f'Token {_i + 1} {ch} failed for {len(_df)} instruments: {_code} {_description}')
+    return report
+
+
+def chunk_payload(subscription_payload: dict, chunk_size: int):
+    """Split a payload into payloads of at most chunk_size instruments each"""
+    instruments = subscription_payload['instruments']
+    for _start in range(0, len(instruments), chunk_size):
+        yield {**subscription_payload, 'instruments': instruments[_start:_start + chunk_size]}
+
+
+def subscription_status(token_idx, subscription_payload: dict, status_code, status: str) -> list:
+    """
+    Per-instrument rows of one (un)subscription response. 'Already subscribed' (e-session-0002) counts as success.
+    """
+    try:
+        response = json_loads(status)
+    except ValueError:
+        response = {}
+    if not isinstance(response, dict):
+        response = {}
+    code = response.get('code', None)
+    description = response.get('description', None if status_code is not None else status)
+    success = status_code == 200 or code == already_subscribed
+    message_code = subscription_payload['xtsMessageCode']
+    return [(token_idx, message_code, _inst['exchangeSegment'], _inst['exchangeInstrumentID'], status_code, code,
+             description, success) for _inst in subscription_payload['instruments']]
 
 
 # create payload - Market data
@@ -115,7 +213,7 @@ def create_payload(inst_id: list = None, exch_seg: list = None):
         elif exch_seg[i] == 'NFO':
             exch_seg[i] = 2
 
-        data = {"exchangeSegment": exch_seg[i], "exchangeInstrumentID": inst_id[i]}
+        data = {"exchangeSegment": exch_seg[i], "exchangeInstrumentID": int(inst_id[i])}
         subscription_payload["instruments"].append(data)
 
     return subscription_payload
@@ -129,7 +227,7 @@ def create_payload_oi(inst_id: list = None, exch_seg: list = None):
         "xtsMessageCode": 1510   # Open Interest (1510)
     }
     for i in range(len(inst_id)):
-        data = {"exchangeSegment": exch_seg[i], "exchangeInstrumentID": inst_id[i]}
+        data = {"exchangeSegment": exch_seg[i], "exchangeInstrumentID": int(inst_id[i])}
         subscription_payload['instruments'].append(data)
 
     return subscription_payload
@@ -151,19 +249,26 @@ def create_payload_oi(inst_id: list = None, exch_seg: list = None):
 #         return "Token not generated"
 
 
+# keep-alive session per worker thread, connections are reused across requests
+def http_session() -> requests.Session:
+    session = getattr(_http_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        _http_local.session = session
+    return session
+
+
 # subscription request
 def subs(subscription_payload, headers):
-    subscription_payload = json.dumps(subscription_payload, default=str)
-    subscription_payload = json.loads(subscription_payload)
-    subscription_response = requests.post(subscription_url, headers=headers, json=subscription_payload)
+    subscription_response = http_session().post(subscription_url, headers=headers, json=subscription_payload)
     return subscription_response.status_code, subscription_response.text
 
 
 # unsubscribe request
 def unsubs(subscription_payload, headers):
-    subscription_payload = json.dumps(subscription_payload, default=str)
-    subscription_payload = json.loads(subscription_payload)
-    subscription_response = requests.put(subscription_url, headers=headers, json=subscription_payload)
+    subscription_response = http_session().put(subscription_url, headers=headers, json=subscription_payload)
     return subscription_response.status_code, subscription_response.text
 
 
@@ -216,6 +321,52 @@ def get_token_header():
     return tokens, headers, userids, choice
 
 
+# Only the fields used downstream are cut straight out of the raw 1502/1510 payloads, market depth is never decoded.
+# Keys are searched in the order XTS publishes them
+md_keys = ['ExchangeInstrumentID', 'ExchangeTimeStamp', 'LastTradedPrice', 'LastTradedQunatity', 'TotalTradedQuantity']
+oi_keys = ['ExchangeInstrumentID', 'OpenInterest']
+
+
+def select_fields(raw_data: str, keys: list):
+    """Raw values of numeric `keys` from a compact JSON string, None if any key is not found in order"""
+    values, pos = [], 0
+    for _key in keys:
+        _key = f'"{_key}":'
+        start = raw_data.find(_key, pos)
+        if start < 0:
+            return None
+        start += len(_key)
+        pos = raw_data.find(',', start)
+        close = raw_data.find('}', start)
+        if pos < 0 or 0 <= close < pos:
+            pos = close
+        values.append(raw_data[start:pos])
+    return values
+
+
+def _number(value, cast=float):
+    return None if value == 'null' else cast(value)
+
+
+def decode_md(raw_data, selective=False) -> dict:
+    """1502 market data payload, only the fields DataHandler reads on the selective path"""
+    values = select_fields(raw_data, md_keys) if selective else None
+    if values is None:
+        return json_loads(raw_data)
+    ins_id, ts, ltp, ltq, volume = values
+    return {'ExchangeInstrumentID': int(ins_id), 'ExchangeTimeStamp': int(ts),
+            'Touchline': {'LastTradedPrice': _number(ltp), 'LastTradedQunatity': _number(ltq),
+                          'TotalTradedQuantity': _number(volume)}}
+
+
+def decode_oi(raw_data, selective=False) -> dict:
+    """1510 open interest payload, only ExchangeInstrumentID and OpenInterest on the selective path"""
+    values = select_fields(raw_data, oi_keys) if selective else None
+    if values is None:
+        return json_loads(raw_data)
+    return {'ExchangeInstrumentID': int(values[0]), 'OpenInterest': _number(values[1], int)}
+
+
 class XtsWS:
     close_time = today + relativedelta(hour=15, minute=35)
 
@@ -233,7 +384,11 @@ class XtsWS:
         self.hist_flag = None  # Unique Every instance
         self.candle_send = candle_send  # Common channel
         self.latest_feed_xref = kwargs.get('latest_feed_xref', None)
+        self.candle_lock = kwargs.get('candle_lock', None)  # Common lock on candle_send
         self.xts_token_xref = kwargs.get('xts_token_xref', {})
+        # Cut out only the used fields instead of decoding market depth. Pays off most without orjson
+        self.selective_decode = kwargs.get('selective_decode', json_loads is json.loads)
+        self.journal = kwargs.get('journal', False)  # Record every tick, see TickJournal
 
         self.xts_ws = socketio.Client(request_timeout=120, logger=False, engineio_logger=False, ssl_verify=False)
         self.xts_ws.on('connect', self.on_connect)
@@ -260,23 +415,34 @@ class XtsWS:
             # Pipes for data processing
             feed_receiver, feed_send = mp.Pipe(duplex=False)
             # Initialize Data Handler (Middleware between Broadcast and Candle)
-            self.handler = DataHandler(sender=feed_send)
+            self.handler = DataHandler(sender=feed_send, token_xref=self.token_xref, mode='xts', name=self.name,
+                                       journal=self.journal)
             self.handler.start_processor()
 
             # Initialize Candle Handler
             # noinspection PyTypeChecker
             self.candle_fut = self.executor.submit(init_candle_creator, self.scrips, self.tokens, self.token_xref,
                                                    feed_receiver, start=True, candle_sender=self.candle_send,
+                                                   candle_lock=self.candle_lock,
                                                    threaded=True, hist_flag=self.hist_flag, name=self.name,
-                                                   shared_xref=self.latest_feed_xref, update_redis=True, mode='xts')
+                                                   shared_xref=self.latest_feed_xref, update_redis=True)
 
             ws_url = f"{socket_url}/apimarketdata/socket.io/?token={self.access_token}&userID={self.user_id}&broadcastMode=Full&publishFormat=JSON"
             self.xts_ws.connect(ws_url, transports='websocket', socketio_path='apimarketdata/socket.io')
-            self.xts_ws.wait()
 
-            while True:
-                logger.info("Non-waiting state")
+            while datetime.now() < self.close_time:
                 sleep(30)
+            logger.info(f'{self.name} Market Closed. Wrapping Up....')
+            self.xts_ws.disconnect()
+            # Sentinel down the pipe: the candle creator sends its last bars and exits
+            self.handler.stop_processor()
+            try:
+                stats = self.candle_fut.result(15)
+                logger.info(f'{self.name} Candle Creator Stats: {stats}')
+            except TimeoutError as exe:
+                logger.info(f'{self.name} Candle Creator Ended with timeout exception: {exe}')
+            except Exception as e:
+                logger.info(f'{self.name} Candle Creator Ended with unexpected exception: {e}')
 
     def on_connect(self):
         logger.info("Connected to Socket")
@@ -289,7 +455,7 @@ class XtsWS:
 
     # @socket.on('1502-json-full')  # market data
     def on_message_md(self, raw_data):
-        data: dict = json.loads(raw_data)
+        data: dict = decode_md(raw_data, self.selective_decode)
         # logger.info(data)
 
         entity_name = self.xts_token_xref.get(data['ExchangeInstrumentID'], None)  # get entity name via exchange id
@@ -300,7 +466,7 @@ class XtsWS:
 
     # @socket.on('1510-json-full')  # OI data
     def on_message_io(self, raw_data):
-        data = json.loads(raw_data)
+        data = decode_oi(raw_data, self.selective_decode)
         # logger.info(data)
 
         entity_name = self.xts_token_xref.get(data['ExchangeInstrumentID'], None) # take entity name via exchange id
@@ -321,8 +487,28 @@ def xts_wrapper(*args, **kwargs):
     logger.error("XTS wrapper exits")
 
 
+def decode_benchmark(payloads: list, repeat=2000):
+    """Per-message decode time in microseconds for every decode path over the recorded payloads"""
+    decoders = {'json': json.loads, 'fast_json': json_loads, 'selective': lambda x: decode_md(x, selective=True)}
+    result = {}
+    for _name, _decoder in decoders.items():
+        st = perf_counter()
+        for _ in range(repeat):
+            for _payload in payloads:
+                _decoder(_payload)
+        result[_name] = round((perf_counter() - st) / (repeat * len(payloads)) * 1e6, 3)
+    return result
+
+
 if __name__ == '__main__':
-    pass
+    # Recorded 1502 payloads, one raw message per line. Falls back to the sample message below
+    payload_path = os.path.join(data_dir, 'xts_1502_payloads.txt')
+    if os.path.exists(payload_path):
+        with open(payload_path) as f:
+            recorded = [_line.strip() for _line in f if _line.strip()]
+    else:
+        recorded = ['{"MessageCode":1502,"MessageVersion":4,"ApplicationType":0,"TokenID":0,"ExchangeSegment":2,"ExchangeInstrumentID":68094,"ExchangeTimeStamp":1396448201,"Bids":[{"Size":250,"Price":518,"TotalOrders":2,"BuyBackMarketMaker":0},{"Size":450,"Price":517.95,"TotalOrders":2,"BuyBackMarketMaker":0},{"Size":100,"Price":517.9,"TotalOrders":1,"BuyBackMarketMaker":0},{"Size":50,"Price":517.85,"TotalOrders":1,"BuyBackMarketMaker":0},{"Size":500,"Price":517.8,"TotalOrders":3,"BuyBackMarketMaker":0}],"Asks":[{"Size":100,"Price":519.5,"TotalOrders":1,"BuyBackMarketMaker":0},{"Size":700,"Price":519.55,"TotalOrders":2,"BuyBackMarketMaker":0},{"Size":250,"Price":519.6,"TotalOrders":2,"BuyBackMarketMaker":0},{"Size":400,"Price":519.65,"TotalOrders":1,"BuyBackMarketMaker":0},{"Size":100,"Price":519.7,"TotalOrders":1,"BuyBackMarketMaker":0}],"Touchline":{"BidInfo":{"Size":250,"Price":518,"TotalOrders":2,"BuyBackMarketMaker":0},"AskInfo":{"Size":100,"Price":519.5,"TotalOrders":1,"BuyBackMarketMaker":0},"LastTradedPrice":518.75,"LastTradedQunatity":50,"TotalBuyQuantity":28750,"TotalSellQuantity":30300,"TotalTradedQuantity":353500,"AverageTradedPrice":534.55,"LastTradedTime":1396448190,"LastUpdateTime":1396448201,"PercentChange":8.775424617320194,"Open":456.9,"High":568.45,"Low":456.9,"Close":476.9,"TotalValueTraded":null,"BuyBackTotalBuy":0,"BuyBackTotalSell":0},"BookType":1,"XMarketType":1,"SequenceNumber":1341194566648050}']
+    print(f'Decode time per message (us) over {len(recorded)} payloads: {decode_benchmark(recorded)}')
 
 # res = create_token()
 # print(res)
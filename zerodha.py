@@ -139,6 +139,8 @@ class ZerodhaWS:
         self.hist_flag = None  # Unique Every instance
         self.candle_send = candle_send  # Common channel
         self.latest_feed_xref = kwargs.get('latest_feed_xref', None)
+        self.candle_lock = kwargs.get('candle_lock', None)  # Common lock on candle_send
+        self.journal = kwargs.get('journal', False)  # Record every tick, see TickJournal
 
         self.kws = initiate_websocket(client)
         self.kws.on_connect = self.ws_on_connect
@@ -163,13 +165,15 @@ class ZerodhaWS:
             feed_receiver, feed_send = Pipe(duplex=False)
             # Initialize Data Handler (Middleware between Broadcast and Candle)
             # self.handler = DataHandler(sender=None)
-            self.handler = DataHandler(sender=feed_send)
+            self.handler = DataHandler(sender=feed_send, token_xref=self.token_xref, name=self.name,
+                                       journal=self.journal)
             self.handler.start_processor()
 
             # Initialize Candle Handler
             # noinspection PyTypeChecker
             self.candle_fut = self.executor.submit(init_candle_creator, self.scrips, self.tokens, self.token_xref,
                                                    feed_receiver, start=True, candle_sender=self.candle_send,
+                                                   candle_lock=self.candle_lock,
                                                    threaded=True, hist_flag=self.hist_flag, name=self.name,
                                                    shared_xref=self.latest_feed_xref, update_redis=True)
 
@@ -181,8 +185,8 @@ class ZerodhaWS:
                     # Stop candle creator
                     self.handler.stop_processor()
                     try:
-                        cc = self.candle_fut.result(15)
-                        cc.stop_processor()
+                        stats = self.candle_fut.result(15)
+                        logger.info(f'{self.name} Candle Creator Stats: {stats}')
                     except TimeoutError as exe:
                         logger.info(f'{self.name} Candle Creator Ended with timeout exception: {exe}')
                     except Exception as e: